@@ -0,0 +1,90 @@
+import heapq
+import itertools
+
+from tornado.concurrent import Future
+
+
+class AdmissionCancelled(Exception):
+    """
+    Raised to a queued spawn that was removed from the queue before it was admitted
+    """
+
+
+class AdmissionController:
+    """
+    Limits the number of Marathon deployments in flight across the hub. Spawns beyond the limit wait in a
+    priority queue (lower value first, then first come first served) and are admitted as deployments finish.
+    """
+    # Priorities
+    ADMIN = 0
+    RETURNING = 1
+    NEW = 2
+
+    def __init__(self, max_inflight):
+        """
+        Args:
+            max_inflight: Maximum number of deployments in flight, 0 for no limit
+        """
+        self.max_inflight = max_inflight
+        self.inflight = set()
+        self.queue = []
+        self.waiting = {}
+        self.counter = itertools.count()
+
+    def acquire(self, username, priority=NEW):
+        """
+        Ask for a deployment slot
+        Returns:
+            A Future resolved once the user is admitted
+        """
+        future = Future()
+        if username in self.inflight:
+            future.set_result(None)
+        elif username in self.waiting:
+            return self.waiting[username][1]
+        elif not self.max_inflight or len(self.inflight) < self.max_inflight:
+            self.inflight.add(username)
+            future.set_result(None)
+        else:
+            entry = [priority, next(self.counter), username]
+            heapq.heappush(self.queue, entry)
+            self.waiting[username] = (entry, future)
+        return future
+
+    def position(self, username):
+        """
+        1-based position of a user in the queue, None when not queued
+        """
+        if username not in self.waiting:
+            return None
+        entry = self.waiting[username][0]
+        return 1 + sum(1 for other, future in self.waiting.values() if other[:2] < entry[:2])
+
+    def queue_length(self):
+        return len(self.waiting)
+
+    def release(self, username):
+        """
+        Give back the deployment slot of a user and admit the next queued users
+        """
+        self.inflight.discard(username)
+        while self.queue and (not self.max_inflight or len(self.inflight) < self.max_inflight):
+            priority, count, next_username = heapq.heappop(self.queue)
+            if next_username is None:
+                # Cancelled entry
+                continue
+            entry, future = self.waiting.pop(next_username)
+            self.inflight.add(next_username)
+            future.set_result(None)
+
+    def cancel(self, username):
+        """
+        Remove a user who gave up from the queue, or free their slot if they were already admitted
+        """
+        if username in self.waiting:
+            entry, future = self.waiting.pop(username)
+            # Lazy removal, the entry is skipped when it reaches the top of the heap
+            entry[2] = None
+            future.set_exception(AdmissionCancelled("%s left the deployment queue" % username))
+        elif username in self.inflight:
+            self.release(username)
@@ -0,0 +1,71 @@
+class DefragmentationPlanner:
+    """
+    Plans moves of single-GPU sessions that free whole hosts for multi-GPU requests. Only exclusive single-GPU
+    sessions of movable users (e.g. idle or running a restartable image) are moved; a host can be freed when
+    every session on it is movable. Evacuating the hosts with the fewest sessions first gives the smallest
+    number of moves for the number of hosts freed.
+    """
+    def __init__(self, gpu_resources):
+        """
+        Args:
+            gpu_resources: GPUResourceAllocator whose allocations are planned over
+        """
+        self.gpu_resources = gpu_resources
+
+    def plan(self, movable, hosts_to_free=None, target_host=None, max_moves=None):
+        """
+        Args:
+            movable: usernames whose sessions may be restarted elsewhere
+            hosts_to_free: Stop after freeing this many hosts, as many as possible by default
+            target_host: Move every session to this host instead of the fullest hosts with free GPUs
+            max_moves: Maximum number of sessions moved
+
+        Returns:
+            freed_hosts: A list of the hostnames left without any allocation
+            moves: A dictionary of the format {username:(from_hostname, to_hostname, to_gpu_id)}
+        """
+        with self.gpu_resources.lock:
+            by_user, by_hostname = self.gpu_resources.get_current_allocations()
+            by_hostname = self.gpu_resources.placeable(by_hostname)
+        movable = set(movable)
+
+        free = {}
+        candidates = []
+        for hostname, info in by_hostname.items():
+            holders = set(username for users in info.values() for username in users)
+            free[hostname] = sorted(gpu_id for gpu_id, users in info.items() if not users)
+            if not holders or hostname == target_host:
+                continue
+            if all(username in movable and len(by_user[username]) == 1 and
+                   not self.gpu_resources.is_shared(by_user[username][0]) for username in holders):
+                candidates.append((len(holders), hostname, sorted(holders)))
+
+        if target_host is not None:
+            destinations = {target_host: free.get(target_host, [])}
+        else:
+            # Completely free hosts are what the plan is for, nothing is moved onto them
+            destinations = dict((hostname, gpu_ids) for hostname, gpu_ids in free.items()
+                                if gpu_ids and len(gpu_ids) < len(by_hostname[hostname]))
+
+        freed_hosts = []
+        moves = {}
+        receiving = set()
+        for cost, hostname, holders in sorted(candidates):
+            if hosts_to_free is not None and len(freed_hosts) >= hosts_to_free:
+                break
+            if max_moves is not None and len(moves) + cost > max_moves:
+                continue
+            if hostname in receiving:
+                continue
+            others = [(len(gpu_ids), name) for name, gpu_ids in destinations.items() if name != hostname and gpu_ids]
+            if sum(count for count, name in others) < cost:
+                continue
+            destinations.pop(hostname, None)
+            # Fill the fullest hosts first so the GPUs left free stay together
+            slots = [(name, gpu_id) for count, name in sorted(others) for gpu_id in destinations[name]][:cost]
+            for username, (to_hostname, to_gpu_id) in zip(holders, slots):
+                destinations[to_hostname].remove(to_gpu_id)
+                receiving.add(to_hostname)
+                moves[username] = (hostname, to_hostname, to_gpu_id)
+            freed_hosts.append(hostname)
+        return freed_hosts, moves
@@ -0,0 +1,57 @@
+import json
+import os
+
+import requests
+
+
+class MesosInventoryProvider:
+    """
+    Discovers GPU hosts from the state endpoint of the Mesos master (e.g. http://master:5050/master/state)
+    or from a local JSON file with the same layout:
+    {
+        "slaves": [
+            {"hostname": "gpu01", "active": true, "resources": {"gpus": 4},
+             "attributes": {"nvidia_driver": "367.57"}}
+        ],
+        "draining_machines": [{"id": {"hostname": "gpu02"}}]
+    }
+    Draining machines can also come from the master's /maintenance/status endpoint.
+    """
+    def __init__(self, state_url, maintenance_url=None, driver_attribute='nvidia_driver', timeout=5):
+        self.state_url = state_url
+        self.maintenance_url = maintenance_url
+        self.driver_attribute = driver_attribute
+        self.timeout = timeout
+
+    def _load(self, location):
+        if os.path.exists(location):
+            with open(location) as f:
+                return json.load(f)
+        response = requests.get(location, timeout=self.timeout, verify=False)
+        response.raise_for_status()
+        return response.json()
+
+    @staticmethod
+    def _machine_hostnames(machines):
+        return set(machine['id']['hostname'] if 'id' in machine else machine['hostname'] for machine in machines)
+
+    def fetch(self):
+        """
+        Returns:
+            inventory: A dictionary of the format {hostname:(number of gpus, driver version, drained)}
+        """
+        state = self._load(self.state_url)
+        maintenance = self._load(self.maintenance_url) if self.maintenance_url else state
+        draining = self._machine_hostnames(maintenance.get('draining_machines', []))
+        draining |= self._machine_hostnames(maintenance.get('down_machines', []))
+
+        inventory = {}
+        for agent in state.get('slaves', state.get('agents', [])):
+            num_gpus = int(agent.get('resources', {}).get('gpus', 0))
+            if not num_gpus:
+                continue
+            hostname = agent['hostname']
+            driver_version = agent.get('attributes', {}).get(self.driver_attribute)
+            drained = hostname in draining or not agent.get('active', True)
+            inventory[hostname] = (num_gpus, driver_version, drained)
+        return inventory
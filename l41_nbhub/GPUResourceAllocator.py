@@ -1,8 +1,85 @@
+from abc import ABCMeta, abstractmethod
 from collections import defaultdict
+import functools
 import json
 import os
+import threading
 
-class FirstFitStrategy:
+
+def _locked(method):
+    """
+    Run under the allocator's lock, allocations and the readers of the status file may be on different threads
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+class AssignmentStrategy(metaclass=ABCMeta):
+    """
+    Base class of the GPU assignment strategies. Subclasses have to implement request_resources; shared and
+    batch requests have working defaults (least-loaded GPUs, and one request_resources call per request),
+    which subclasses may override.
+    """
+    @abstractmethod
+    def request_resources(self, state, username, num_gpus):
+        """
+        Place an exclusive request
+        Args:
+            state: A dictionary of the format {hostname:{gpu_id:[usernames]}}
+
+        Returns:
+            (hostname, gpu_ids): (None, None) if the request cannot be fulfilled
+        """
+
+    def request_shared_resources(self, load, username, num_gpus, capacity):
+        """
+        Place a shared request on the least-loaded GPUs. Only GPUs with a free slot are considered, and the host
+        whose chosen GPUs carry the smallest total load wins (ties broken by hostname).
+        Args:
+            load: A dictionary of the format {hostname:{gpu_id:slots_in_use}} with exclusive GPUs left out
+            capacity: Maximum number of users on a single GPU
+        """
+        best = None
+        for hostname, info in sorted(load.items()):
+            candidates = sorted((used, gpu_id) for gpu_id, used in info.items() if used < capacity)
+            if len(candidates) < num_gpus:
+                continue
+            chosen = candidates[:num_gpus]
+            total = sum(used for used, gpu_id in chosen)
+            if best is None or total < best[0]:
+                best = (total, hostname, sorted(gpu_id for used, gpu_id in chosen))
+        if best is None:
+            return None, None # cannot fulfill request
+        return best[1], best[2]
+
+    def request_batch_resources(self, state, requests):
+        """
+        Place many exclusive requests together, one request_resources call per request, largest first
+        Args:
+            state: A dictionary of the format {hostname:{gpu_id:[usernames]}}
+            requests: A list of tuples of (username, num_gpus)
+
+        Returns:
+            placements: A dictionary of the format {username:(hostname,[gpu_ids])}
+            rejected: A list of the usernames that could not be placed
+        """
+        state = dict((hostname, dict((gpu_id, list(holders)) for gpu_id, holders in info.items()))
+                     for hostname, info in state.items())
+        placements = {}
+        rejected = []
+        for username, num_gpus in sorted(requests, key=lambda request: (-request[1], request[0])):
+            hostname, gpu_ids = self.request_resources(state, username, num_gpus)
+            if not hostname or not gpu_ids:
+                rejected.append(username)
+                continue
+            for gpu_id in gpu_ids:
+                state[hostname][gpu_id].append(username)
+            placements[username] = (hostname, gpu_ids)
+        return placements, rejected
+
+class FirstFitStrategy(AssignmentStrategy):
     """
     A straightforward greedy approximation algorithm. For each request, attempt to place the container on the first host that can accomodate the number of requested GPUs.
     """
@@ -12,50 +89,150 @@ class FirstFitStrategy:
     def request_resources(self, state, username, num_gpus):
         for hostname, info in sorted(state.items()):
             possible = []
-            for gpu_id, username in sorted(info.items()):
-                if not username:
+            for gpu_id, holders in sorted(info.items()):
+                if not holders:
                     possible.append(gpu_id)
                 if len(possible) == num_gpus:
                     return hostname, possible
         return None, None # cannot fulfill request
 
+    def request_batch_resources(self, state, requests):
+        """
+        Place many exclusive requests together. The requests that can be satisfied are picked smallest first
+        (which maximizes how many are satisfied), then packed largest first into the host with the fewest free
+        GPUs that still fits (best fit decreasing), which keeps whole hosts free for multi-GPU requests.
+        Requests that did not fit get a second, smallest first, pass over the remaining space.
+        Args:
+            state: A dictionary of the format {hostname:{gpu_id:[usernames]}}
+            requests: A list of tuples of (username, num_gpus)
+
+        Returns:
+            placements: A dictionary of the format {username:(hostname,[gpu_ids])}
+            rejected: A list of the usernames that could not be placed
+        """
+        free = {hostname: sorted(gpu_id for gpu_id, holders in info.items() if not holders)
+                for hostname, info in state.items()}
+        max_free = max([len(gpu_ids) for gpu_ids in free.values()] or [0])
+        # Hosts bucketed by number of free GPUs, the smallest hostname at the end of each bucket
+        buckets = [[] for i in range(max_free + 1)]
+        for hostname in sorted(free, reverse=True):
+            buckets[len(free[hostname])].append(hostname)
+
+        def place(username, num_gpus):
+            for count in range(num_gpus, max_free + 1):
+                if buckets[count]:
+                    hostname = buckets[count].pop()
+                    gpu_ids, free[hostname] = free[hostname][:num_gpus], free[hostname][num_gpus:]
+                    buckets[count - num_gpus].append(hostname)
+                    placements[username] = (hostname, gpu_ids)
+                    return True
+            return False
+
+        placements = {}
+        capacity = sum(len(gpu_ids) for gpu_ids in free.values())
+        selected, leftover = [], []
+        for username, num_gpus in sorted(requests, key=lambda request: (request[1], request[0])):
+            if num_gpus <= capacity:
+                selected.append((username, num_gpus))
+                capacity -= num_gpus
+            else:
+                leftover.append((username, num_gpus))
+
+        for username, num_gpus in sorted(selected, key=lambda request: (-request[1], request[0])):
+            if not place(username, num_gpus):
+                leftover.append((username, num_gpus))
+
+        rejected = []
+        for username, num_gpus in sorted(leftover, key=lambda request: (request[1], request[0])):
+            if not place(username, num_gpus):
+                rejected.append(username)
+        return placements, rejected
+
 class GPUResourceAllocator:
     """
     Quick and dirty class to manage GPU allocations. Uses flat files which are read at each instance
 
     """
-    def __init__(self, resource_filename, status_filename, assignment_strategy=None, allow_oversubscription=True):
+    def __init__(self, resource_filename, status_filename, assignment_strategy=None, allow_oversubscription=True,
+                 gpu_capacity=4):
         """
         Initialize GPUResourceAllocator
         Args:
             resource_filename: Filename of a text file of the format "hostname #gpus\n hostname #gpus"
-            status_filename: A json object of the format {username:(hostname,gpuid)}
+            status_filename: A json object of the format {username:[(hostname,gpuid,shared)]}
+            allow_oversubscription: Whether shared requests may place several users on the same GPU
+            gpu_capacity: Maximum number of users sharing a single GPU when oversubscription is allowed
 
         Returns:
 
         """
         self.resource_filename = resource_filename
         self.status_filename = status_filename
-        self.allow_oversubscription = allow_oversubscription # TODO not currently doing anything with this right now
+        self.allow_oversubscription = allow_oversubscription
+        self.gpu_capacity = gpu_capacity
         if not assignment_strategy:
             assignment_strategy = FirstFitStrategy()
         self.assignment_strategy = assignment_strategy # Maybe we want to change the assignment strategy in the future?
-    
+        # Filled by update_inventory, takes the place of the resources file once set
+        self.inventory = None
+        self.drained_hosts = set()
+        self.driver_versions = {}
+        self.lock = threading.RLock()
+
+    @_locked
+    def update_inventory(self, inventory):
+        """
+        Apply a discovered inventory to the in-memory state. Only hosts whose entry changed are touched.
+        Hosts that disappeared are kept (their GPUs may still be allocated) but marked as drained.
+        Args:
+            inventory: A dictionary of the format {hostname:(number of gpus, driver version, drained)}
+
+        Returns:
+            changed: A list of the hostnames that were added, modified or drained
+        """
+        if self.inventory is None:
+            self.inventory = {}
+        changed = []
+        for hostname, entry in inventory.items():
+            if self.inventory.get(hostname) != entry:
+                self.inventory[hostname] = entry
+                changed.append(hostname)
+        for hostname, (num_gpus, driver_version, drained) in list(self.inventory.items()):
+            if hostname not in inventory and not drained:
+                self.inventory[hostname] = (num_gpus, driver_version, True)
+                changed.append(hostname)
+
+        for hostname in changed:
+            num_gpus, driver_version, drained = self.inventory[hostname]
+            if driver_version:
+                self.driver_versions[hostname] = driver_version
+            else:
+                self.driver_versions.pop(hostname, None)
+            if drained:
+                self.drained_hosts.add(hostname)
+            else:
+                self.drained_hosts.discard(hostname)
+        return sorted(changed)
+
     def get_resources(self):
         """
-        Gets the available resources from the specified text file
+        Gets the available resources from the discovered inventory, or the specified text file
         Returns:
             resources: A list of the available resources, tuple of (hostname, number of gpus)
         """
-        self.driver_versions = {}
+        if self.inventory is not None:
+            return [(hostname, entry[0]) for hostname, entry in sorted(self.inventory.items())]
+        driver_versions = {}
         resources = []
         with open(self.resource_filename) as input_file:
             for line in input_file:
                 line = line.split()
                 # 0=hostname, 1=number of gpus, 2=driver version
                 resources.append((line[0], int(line[1])))
-                if len(line) > 1:
-                    self.driver_versions[line[0]] = line[2]
+                if len(line) > 2:
+                    driver_versions[line[0]] = line[2]
+        # Swapped in whole, get_driver_version is called without the lock
+        self.driver_versions = driver_versions
         return resources
 
     def get_driver_version(self, hostname):
@@ -64,16 +241,16 @@ class GPUResourceAllocator:
         else:
             return None
 
+    @_locked
     def get_current_allocations(self):
         """
         Get the current state of gpu allocations
         Returns:
-            by_user: A dictionary of the format {username:[(hostname,gpuid)]}
-            by_hostname: A dictionary of the format {hostname:{gpu_id:username}}
+            by_user: A dictionary of the format {username:[(hostname,gpuid,shared)]}
+            by_hostname: A dictionary of the format {hostname:{gpu_id:[usernames]}}
         """
         if not os.path.exists(self.status_filename):
-            with open(self.status_filename, 'w') as fOut:
-                json.dump({}, fOut, indent=4)
+            self.save_current_allocations({})
             
         # user:{[(host,id)]}
         with open(self.status_filename) as f:
@@ -83,23 +260,67 @@ class GPUResourceAllocator:
         by_hostname = defaultdict(dict)
         for username, info in by_user.items():
             for data in info:
-                hostname, gpu_id = data
-                by_hostname[hostname][gpu_id] = username
+                hostname, gpu_id = data[0], data[1]
+                by_hostname[hostname].setdefault(gpu_id, []).append(username)
         for hostname, num_gpus in resources:
             for gpu_id in range(num_gpus):
                 if gpu_id not in by_hostname[hostname]:
-                    by_hostname[hostname][gpu_id] = None
+                    by_hostname[hostname][gpu_id] = []
 
         return by_user, by_hostname
 
+    def placeable(self, by_hostname):
+        """
+        Leave drained hosts out of a {hostname:...} dictionary so no new work is placed on them
+        """
+        if not self.drained_hosts:
+            return by_hostname
+        return {hostname: info for hostname, info in by_hostname.items() if hostname not in self.drained_hosts}
+
+    @staticmethod
+    def is_shared(allocation):
+        """
+        Whether a single (hostname, gpu_id[, shared]) entry of the status file was made in shared mode.
+        Entries written before sharing existed have no flag and are exclusive.
+        """
+        return len(allocation) > 2 and bool(allocation[2])
+
+    def get_gpu_load(self, by_user):
+        """
+        Count the slots in use on every GPU that can still take shared users
+        Args:
+            by_user: A dictionary of the format {username:[(hostname,gpuid,shared)]}
+
+        Returns:
+            load: A dictionary of the format {hostname:{gpu_id:slots_in_use}}, exclusive GPUs are left out
+        """
+        load = defaultdict(dict)
+        exclusive = set()
+        for hostname, num_gpus in self.get_resources():
+            for gpu_id in range(num_gpus):
+                load[hostname][gpu_id] = 0
+        for username, info in by_user.items():
+            for data in info:
+                hostname, gpu_id = data[0], data[1]
+                if self.is_shared(data):
+                    load[hostname][gpu_id] = load[hostname].get(gpu_id, 0) + 1
+                else:
+                    exclusive.add((hostname, gpu_id))
+        for hostname, gpu_id in exclusive:
+            load[hostname].pop(gpu_id, None)
+        return load
+
     def save_current_allocations(self, current_allocations):
         """
-        Save the current state of gpu allocations
+        Save the current state of gpu allocations. The file is replaced in one step, so other processes reading
+        it (e.g. snapshot collection) never see it half written.
         Args:
             current_allocations: A dictionary of the format {username:(hostname,gpuid)}
         """
-        with open(self.status_filename, 'w') as fOut:
+        temp_filename = '%s.%i.tmp' % (self.status_filename, os.getpid())
+        with open(temp_filename, 'w') as fOut:
             json.dump(current_allocations, fOut, indent=4)
+        os.replace(temp_filename, self.status_filename)
 
     """
     # TO DELETE
@@ -111,12 +332,15 @@ class GPUResourceAllocator:
         raise ValueError('Should never get here')
     """
         
-    def get_host_id(self, desired_username, num_gpus):
+    @_locked
+    def get_host_id(self, desired_username, num_gpus, shared=False):
         """
         Returns the hostname/id to assign a given user
         Args:
             desired_username: the username to allocate resources for
             num_gpus: requessted number of gpus
+            shared: request GPU slots that may be shared with other users instead of whole GPUs.
+                Ignored (exclusive placement) when oversubscription is not allowed.
 
         Returns:
             (Hostname, GPU_IDs): Tuple of resources to be assigned
@@ -128,13 +352,20 @@ class GPUResourceAllocator:
             # Note: assuming 1 hostname only (1 container deployment)
             hostname = None
             gpu_ids = []
-            for hname, gpu_id in allocations_by_user[desired_username]:
+            for data in allocations_by_user[desired_username]:
                 if not hostname:
-                    hostname = hname
-                gpu_ids.append(gpu_id)
+                    hostname = data[0]
+                gpu_ids.append(data[1])
             return hostname, gpu_ids
-       
-        hostname, gpu_ids = self.assignment_strategy.request_resources(allocations_by_host, desired_username, num_gpus) 
+
+        shared = shared and self.allow_oversubscription and self.gpu_capacity > 1
+        if shared:
+            load = self.placeable(self.get_gpu_load(allocations_by_user))
+            hostname, gpu_ids = self.assignment_strategy.request_shared_resources(load, desired_username, num_gpus,
+                                                                                 self.gpu_capacity)
+        else:
+            hostname, gpu_ids = self.assignment_strategy.request_resources(self.placeable(allocations_by_host),
+                                                                           desired_username, num_gpus)
         if not hostname or not gpu_ids:
             raise ValueError("No resources available to fulfill request.")                
 
@@ -142,10 +373,70 @@ class GPUResourceAllocator:
         if desired_username not in allocations_by_user:
             allocations_by_user[desired_username] = list()
         for gpu_id in gpu_ids:
-            allocations_by_user[desired_username].append((hostname, gpu_id))
+            allocations_by_user[desired_username].append((hostname, gpu_id, shared))
         self.save_current_allocations(allocations_by_user)
         return hostname, gpu_ids       
     
+    @_locked
+    def get_host_ids(self, requests):
+        """
+        Assign exclusive GPUs to many users at once and save all the assignments in a single write
+        Args:
+            requests: A list of tuples of (username, num_gpus)
+
+        Returns:
+            placements: A dictionary of the format {username:(hostname,[gpu_ids])}, including users that
+                already had resources assigned
+            rejected: A list of the usernames that could not be placed
+        """
+        allocations_by_user, allocations_by_host = self.get_current_allocations()
+
+        placements = {}
+        pending = []
+        for username, num_gpus in requests:
+            if username in allocations_by_user:
+                info = allocations_by_user[username]
+                placements[username] = (info[0][0] if info else None, [data[1] for data in info])
+            elif num_gpus > 0:
+                pending.append((username, num_gpus))
+
+        new_placements, rejected = self.assignment_strategy.request_batch_resources(self.placeable(allocations_by_host),
+                                                                                   pending)
+        for username, (hostname, gpu_ids) in new_placements.items():
+            allocations_by_user[username] = [(hostname, gpu_id, False) for gpu_id in gpu_ids]
+        if new_placements:
+            self.save_current_allocations(allocations_by_user)
+        placements.update(new_placements)
+        return placements, rejected
+
+    @_locked
+    def move_allocations(self, moves):
+        """
+        Reassign users to other GPUs (e.g. a defragmentation plan) and save all the moves in a single write.
+        Users whose target GPU was taken in the meantime are not moved.
+        Args:
+            moves: A dictionary of the format {username:(hostname,[gpu_ids])}
+
+        Returns:
+            moved: the usernames that were reassigned
+        """
+        allocations_by_user, allocations_by_host = self.get_current_allocations()
+        moved = []
+        for username, (hostname, gpu_ids) in sorted(moves.items()):
+            holders = allocations_by_host[hostname]
+            if any(gpu_id not in holders or holders[gpu_id] not in ([], [username]) for gpu_id in gpu_ids):
+                continue
+            for data in allocations_by_user.get(username, []):
+                allocations_by_host[data[0]][data[1]].remove(username)
+            allocations_by_user[username] = [(hostname, gpu_id, False) for gpu_id in gpu_ids]
+            for gpu_id in gpu_ids:
+                holders[gpu_id] = [username]
+            moved.append(username)
+
+        if moved:
+            self.save_current_allocations(allocations_by_user)
+        return moved
+
     def release_resource(self, desired_username):
         """
         Return the resources for a given user to the pool
@@ -154,9 +445,24 @@ class GPUResourceAllocator:
 
         Returns:
 
+        """
+        self.release_resources([desired_username])
+
+    @_locked
+    def release_resources(self, usernames):
+        """
+        Return the resources of many users to the pool with a single write
+        Args:
+            usernames: usernames to return resources for
+
+        Returns:
+            released: the usernames that held resources
         """
         allocations_by_user, allocations_by_host = self.get_current_allocations()
-        if desired_username in allocations_by_user:
-            del allocations_by_user[desired_username]
-        
-        self.save_current_allocations(allocations_by_user)
+        released = [username for username in usernames if username in allocations_by_user]
+        for username in released:
+            del allocations_by_user[username]
+
+        if released:
+            self.save_current_allocations(allocations_by_user)
+        return released
@@ -0,0 +1,264 @@
+import argparse
+import heapq
+import importlib
+import json
+import math
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from .GPUResourceAllocator import FirstFitStrategy, GPUResourceAllocator
+
+'''
+Replay GPU request traces against GPUResourceAllocator to compare assignment strategies offline.
+
+A trace is a list of tuples of (arrival, duration, username, num_gpus, shared), times in seconds.
+Requests that cannot be placed wait (first come first served) until GPUs are released, and are rejected
+once they waited longer than max_wait. Everything except the wall clock measurements is seeded, so the
+same arguments always give the same table.
+
+    python -m l41_nbhub.GPUSimulator --hosts 10 100 1000
+'''
+
+
+def synthetic_trace(num_events, total_gpus, load=0.8, mean_duration=3600, gpu_choices=(1, 1, 1, 1, 2, 2, 4),
+                    shared_fraction=0.0, seed=0):
+    """
+    Poisson arrivals with exponential durations, the arrival rate is chosen so the requested GPUs average
+    `load` of the cluster
+    Args:
+        total_gpus: Number of GPUs in the simulated cluster
+        gpu_choices: Number of GPUs of a request, drawn uniformly from this list
+        shared_fraction: Fraction of the requests asking for shared GPUs
+    """
+    rng = random.Random(seed)
+    mean_gpus = float(sum(gpu_choices)) / len(gpu_choices)
+    rate = load * total_gpus / (mean_gpus * mean_duration)
+    trace = []
+    now = 0.0
+    for i in range(num_events):
+        now += rng.expovariate(rate)
+        trace.append((now, rng.expovariate(1.0 / mean_duration), 'user%05d' % i, rng.choice(gpu_choices),
+                      rng.random() < shared_fraction))
+    return trace
+
+
+def trace_from_snapshots(filenames):
+    """
+    Build a trace from historical status.json snapshots, ordered by modification time. A user appearing in a
+    snapshot arrives at its time and leaves at the time of the first snapshot without them.
+    """
+    filenames = sorted(filenames, key=os.path.getmtime)
+    trace = []
+    active = {}
+    timestamp = None
+    for filename in filenames:
+        timestamp = os.path.getmtime(filename)
+        with open(filename) as f:
+            by_user = json.load(f)
+        for username in list(active):
+            if username not in by_user:
+                arrival, num_gpus, shared = active.pop(username)
+                trace.append((arrival, timestamp - arrival, username, num_gpus, shared))
+        for username, info in by_user.items():
+            if username not in active and info:
+                active[username] = (timestamp, len(info), any(GPUResourceAllocator.is_shared(data) for data in info))
+    for username, (arrival, num_gpus, shared) in active.items():
+        trace.append((arrival, timestamp - arrival, username, num_gpus, shared))
+    if not trace:
+        return trace
+    start = min(event[0] for event in trace)
+    return sorted((arrival - start, duration, username, num_gpus, shared)
+                  for arrival, duration, username, num_gpus, shared in trace)
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(fraction * len(values))) - 1)]
+
+
+def simulate(trace, num_hosts, gpus_per_host=4, strategy=None, max_wait=900, allow_oversubscription=True,
+             gpu_capacity=4):
+    """
+    Replay a trace against a GPUResourceAllocator over a synthetic inventory, with its status file in a
+    temporary directory
+    Args:
+        strategy: Assignment strategy given to the allocator, FirstFitStrategy by default
+        max_wait: Seconds a request may wait for GPUs before it is rejected, 0 to reject at once
+
+    Returns:
+        A dictionary of the metrics: requests, rejection_rate, fragmentation (mean fraction of the free GPUs
+        that are not on a completely free host, sampled at every arrival), wait_mean/wait_p95 (simulated
+        seconds to placement of the placed requests), calls and calls_per_sec (allocator throughput)
+    """
+    directory = tempfile.mkdtemp(prefix='gpusim')
+    try:
+        allocator = GPUResourceAllocator(os.path.join(directory, 'resources'), os.path.join(directory, 'status.json'),
+                                         assignment_strategy=strategy, allow_oversubscription=allow_oversubscription,
+                                         gpu_capacity=gpu_capacity)
+        allocator.update_inventory(dict(('host%04d' % i, (gpus_per_host, None, False)) for i in range(num_hosts)))
+
+        holders = {}  # (hostname, gpu_id) -> number of users
+        used_per_host = dict(('host%04d' % i, 0) for i in range(num_hosts))
+        total_gpus = num_hosts * gpus_per_host
+        counters = {'calls': 0, 'seconds': 0.0}
+
+        def call(method, *args):
+            start = time.time()
+            try:
+                return method(*args)
+            finally:
+                counters['calls'] += 1
+                counters['seconds'] += time.time() - start
+
+        def try_place(username, num_gpus, shared):
+            try:
+                hostname, gpu_ids = call(allocator.get_host_id, username, num_gpus, shared)
+            except ValueError:
+                return None
+            for gpu_id in gpu_ids:
+                holders[hostname, gpu_id] = holders.get((hostname, gpu_id), 0) + 1
+                if holders[hostname, gpu_id] == 1:
+                    used_per_host[hostname] += 1
+            return hostname, gpu_ids
+
+        events = []  # heap of (time, kind, ...), departures sort before arrivals at the same time
+        for arrival, duration, username, num_gpus, shared in trace:
+            heapq.heappush(events, (arrival, 1, username, num_gpus, shared, duration))
+        waiting = []
+        placements = {}
+        waits = []
+        rejected = 0
+        fragmentation = []
+
+        def admit_waiting(now):
+            rejected_now = 0
+            while waiting:
+                arrival, username, num_gpus, shared, duration = waiting[0]
+                if now - arrival > max_wait:
+                    waiting.pop(0)
+                    rejected_now += 1
+                    continue
+                placement = try_place(username, num_gpus, shared)
+                if placement is None:
+                    break
+                waiting.pop(0)
+                placements[username] = placement
+                waits.append(now - arrival)
+                heapq.heappush(events, (now + duration, 0, username))
+            return rejected_now
+
+        while events:
+            event = heapq.heappop(events)
+            now = event[0]
+            if event[1] == 0:
+                username = event[2]
+                hostname, gpu_ids = placements.pop(username)
+                call(allocator.release_resource, username)
+                for gpu_id in gpu_ids:
+                    holders[hostname, gpu_id] -= 1
+                    if not holders[hostname, gpu_id]:
+                        used_per_host[hostname] -= 1
+                rejected += admit_waiting(now)
+                continue
+
+            username, num_gpus, shared, duration = event[2:]
+            free = total_gpus - sum(used_per_host.values())
+            if free:
+                whole = sum(gpus_per_host for used in used_per_host.values() if not used)
+                fragmentation.append(1 - float(whole) / free)
+            if max_wait == 0:
+                placement = try_place(username, num_gpus, shared)
+                if placement is None:
+                    rejected += 1
+                else:
+                    placements[username] = placement
+                    waits.append(0.0)
+                    heapq.heappush(events, (now + duration, 0, username))
+                continue
+            waiting.append((now, username, num_gpus, shared, duration))
+            if len(waiting) == 1:
+                rejected += admit_waiting(now)
+        rejected += len(waiting)
+
+        return {
+            'requests': len(trace),
+            'rejection_rate': float(rejected) / len(trace) if trace else 0.0,
+            'fragmentation': sum(fragmentation) / len(fragmentation) if fragmentation else 0.0,
+            'wait_mean': sum(waits) / len(waits) if waits else 0.0,
+            'wait_p95': _percentile(waits, 0.95),
+            'calls': counters['calls'],
+            'calls_per_sec': counters['calls'] / counters['seconds'] if counters['seconds'] else 0.0,
+        }
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def benchmark(host_counts=(10, 100, 1000), strategies=None, trace=None, num_events=None, gpus_per_host=4,
+              load=0.8, max_wait=900, seed=0):
+    """
+    Simulate every strategy for every cluster size
+    Args:
+        strategies: A dictionary of the format {name:strategy}, only FirstFitStrategy by default
+        trace: Trace replayed on every cluster size, by default a synthetic trace sized to each cluster
+        num_events: Length of the synthetic traces, by default 3 requests per GPU (at least 1000) so large
+            clusters also reach their steady state load
+
+    Returns:
+        rows: A list of dictionaries of the metrics, with the strategy name and number of hosts
+    """
+    strategies = strategies or {'FirstFitStrategy': FirstFitStrategy()}
+    rows = []
+    for num_hosts in host_counts:
+        total_gpus = num_hosts * gpus_per_host
+        replayed = trace or synthetic_trace(num_events or max(1000, 3 * total_gpus), total_gpus, load=load, seed=seed)
+        for name, strategy in sorted(strategies.items()):
+            row = simulate(replayed, num_hosts, gpus_per_host=gpus_per_host, strategy=strategy, max_wait=max_wait)
+            row.update(strategy=name, hosts=num_hosts)
+            rows.append(row)
+    return rows
+
+
+def format_table(rows):
+    columns = [('strategy', '%s'), ('hosts', '%d'), ('requests', '%d'), ('rejection_rate', '%.3f'),
+               ('fragmentation', '%.3f'), ('wait_mean', '%.1f'), ('wait_p95', '%.1f'), ('calls', '%d'),
+               ('calls_per_sec', '%.0f')]
+    cells = [[name for name, fmt in columns]] + [[fmt % row[name] for name, fmt in columns] for row in rows]
+    widths = [max(len(line[i]) for line in cells) for i in range(len(columns))]
+    return '\n'.join('  '.join(cell.rjust(width) for cell, width in zip(line, widths)) for line in cells)
+
+
+def load_strategy(path):
+    """
+    Instantiate a strategy, a subclass of AssignmentStrategy, from "module:ClassName"
+    """
+    module_name, class_name = path.split(':')
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare GPU assignment strategies on replayed request traces")
+    parser.add_argument('--hosts', type=int, nargs='+', default=[10, 100, 1000], help="cluster sizes to simulate")
+    parser.add_argument('--gpus-per-host', type=int, default=4)
+    parser.add_argument('--events', type=int, help="number of requests of the synthetic trace (3 per GPU)")
+    parser.add_argument('--load', type=float, default=0.8, help="requested fraction of the cluster's GPUs")
+    parser.add_argument('--max-wait', type=float, default=900, help="seconds a request may wait for GPUs")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--strategy', action='append', default=[],
+                        help="strategy to compare, as module:ClassName (FirstFitStrategy if not given)")
+    parser.add_argument('--snapshots', nargs='+', help="replay status.json snapshots instead of a synthetic trace")
+    args = parser.parse_args()
+
+    strategies = dict((path.split(':')[1], load_strategy(path)) for path in args.strategy) or None
+    trace = trace_from_snapshots(args.snapshots) if args.snapshots else None
+    rows = benchmark(args.hosts, strategies, trace=trace, num_events=args.events, gpus_per_host=args.gpus_per_host,
+                     load=args.load, max_wait=args.max_wait, seed=args.seed)
+    print(format_table(rows))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+from array import array
+import json
+import os
+import time
+
+import requests
+
+
+class FileUtilizationSource:
+    """
+    Reads utilization samples that agents append to a local file, one JSON object per line:
+    {"hostname": "gpu01", "gpu_id": 0, "utilization": 12.5, "timestamp": 1476900000.0}
+    Only lines written since the previous read are returned.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.offset = 0
+
+    def read_samples(self):
+        """
+        Returns:
+            samples: A list of tuples of (hostname, gpu_id, timestamp, utilization)
+        """
+        if not os.path.exists(self.filename):
+            return []
+        if os.path.getsize(self.filename) < self.offset:
+            # File was rotated or truncated, start over
+            self.offset = 0
+        samples = []
+        with open(self.filename) as f:
+            f.seek(self.offset)
+            for line in f:
+                if not line.endswith('\n'):
+                    # Partially written line, pick it up on the next read
+                    break
+                self.offset += len(line)
+                sample = _parse_sample(line)
+                if sample:
+                    samples.append(sample)
+        return samples
+
+
+class HTTPUtilizationSource:
+    """
+    Polls a URL returning a JSON list of samples in the same format as FileUtilizationSource.
+    """
+    def __init__(self, url, timeout=5):
+        self.url = url
+        self.timeout = timeout
+
+    def read_samples(self):
+        response = requests.get(self.url, timeout=self.timeout, verify=False)
+        if response.status_code != 200:
+            return []
+        return [sample for sample in map(_parse_sample, response.json()) if sample]
+
+
+def _parse_sample(data):
+    try:
+        if isinstance(data, str):
+            data = json.loads(data)
+        return (data['hostname'], int(data['gpu_id']),
+                float(data.get('timestamp', time.time())), float(data['utilization']))
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def utilization_source(location):
+    """
+    Pick a source for a local path or a URL, following the env_url/path_to_image_list convention
+    """
+    if os.path.exists(location) or '://' not in location:
+        return FileUtilizationSource(location)
+    return HTTPUtilizationSource(location)
+
+
+class SampleRing:
+    """
+    Fixed size ring buffer of (timestamp, utilization) samples for a single GPU, stored in flat arrays.
+    """
+    __slots__ = ('timestamps', 'values', 'size', 'count', 'head')
+
+    def __init__(self, size):
+        self.timestamps = array('d', [0.0] * size)
+        self.values = array('f', [0.0] * size)
+        self.size = size
+        self.count = 0
+        self.head = 0
+
+    def append(self, timestamp, utilization):
+        self.timestamps[self.head] = timestamp
+        self.values[self.head] = utilization
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def oldest(self):
+        if not self.count:
+            return None
+        return self.timestamps[(self.head - self.count) % self.size]
+
+    def newest(self):
+        if not self.count:
+            return None
+        return self.timestamps[(self.head - 1) % self.size]
+
+    def recent_values(self):
+        """
+        All utilization values currently held, in no particular order
+        """
+        if self.count < self.size:
+            return list(self.values[:self.count])
+        return list(self.values)
+
+    def max_since(self, since):
+        """
+        Highest utilization among the samples taken at or after `since`, None if there are none
+        """
+        peak = None
+        for i in range(1, self.count + 1):
+            idx = (self.head - i) % self.size
+            if self.timestamps[idx] < since:
+                break
+            if peak is None or self.values[idx] > peak:
+                peak = self.values[idx]
+        return peak
+
+
+class GPUTelemetryCollector:
+    """
+    Keeps recent utilization samples for every GPU and finds allocations that have been idle for too long.
+    A user is idle when every GPU allocated to them stayed below `idle_utilization` over the last
+    `idle_timeout` seconds. Idle users are first warned, then reported for release once `warning_period`
+    seconds have passed without activity.
+    """
+    def __init__(self, source, gpu_resources, samples_per_gpu=256, idle_timeout=4*3600, idle_utilization=5.0,
+                 warning_period=1800):
+        self.source = source
+        self.gpu_resources = gpu_resources
+        self.samples_per_gpu = samples_per_gpu
+        self.idle_timeout = idle_timeout
+        self.idle_utilization = idle_utilization
+        self.warning_period = warning_period
+        self.rings = {}
+        self.warned = {}
+        self.first_seen = {}
+
+    def collect(self):
+        """
+        Pull new samples from the source into the ring buffers
+        Returns:
+            Number of samples ingested
+        """
+        return self.ingest(self.source.read_samples())
+
+    def ingest(self, samples):
+        """
+        Add samples read from the source (which may block, e.g. HTTPUtilizationSource) to the ring buffers
+        Args:
+            samples: A list of tuples of (hostname, gpu_id, timestamp, utilization)
+
+        Returns:
+            Number of samples ingested
+        """
+        for hostname, gpu_id, timestamp, utilization in samples:
+            key = (hostname, gpu_id)
+            if key not in self.rings:
+                self.rings[key] = SampleRing(self.samples_per_gpu)
+            ring = self.rings[key]
+            newest = ring.newest()
+            if newest is not None and timestamp < newest:
+                # Out of order sample, the ring only keeps samples in time order
+                continue
+            ring.append(timestamp, utilization)
+        return len(samples)
+
+    def is_idle(self, hostname, gpu_id, now=None):
+        """
+        Whether a GPU has samples covering the whole idle window and all of them are below the threshold.
+        GPUs without enough history are never considered idle.
+        """
+        now = now or time.time()
+        ring = self.rings.get((hostname, gpu_id))
+        if ring is None or ring.oldest() > now - self.idle_timeout:
+            return False
+        peak = ring.max_since(now - self.idle_timeout)
+        return peak is not None and peak < self.idle_utilization
+
+    def find_idle_users(self, now=None):
+        """
+        Returns:
+            idle: A list of usernames whose allocated GPUs are all idle
+        """
+        now = now or time.time()
+        by_user, by_hostname = self.gpu_resources.get_current_allocations()
+        for username in list(self.first_seen):
+            if username not in by_user:
+                del self.first_seen[username]
+
+        idle = []
+        for username, info in sorted(by_user.items()):
+            # Samples from before the allocation belong to somebody else
+            first_seen = self.first_seen.setdefault(username, now)
+            if now - first_seen < self.idle_timeout:
+                continue
+            if info and all(self.is_idle(data[0], data[1], now) for data in info):
+                idle.append(username)
+        return idle
+
+    def check_idle(self, now=None):
+        """
+        Advance the warn-then-release cycle
+        Returns:
+            (to_warn, to_release): usernames that just became idle, and usernames that stayed idle
+            for the whole warning period
+        """
+        now = now or time.time()
+        idle = set(self.find_idle_users(now))
+        for username in list(self.warned):
+            if username not in idle:
+                del self.warned[username]
+
+        to_warn, to_release = [], []
+        for username in sorted(idle):
+            if username not in self.warned:
+                self.warned[username] = now
+                to_warn.append(username)
+            elif now - self.warned[username] >= self.warning_period:
+                to_release.append(username)
+        return to_warn, to_release
+
+    def forget(self, username):
+        self.warned.pop(username, None)
+        self.first_seen.pop(username, None)
@@ -1,17 +1,36 @@
 import time
-import os
 import json
 import requests
-from traitlets import Dict, Int, List, Unicode
-from tornado import gen
+from traitlets import Bool, Dict, Float, Int, List, Unicode
+from tornado import gen, locks
+from tornado.httpclient import AsyncHTTPClient, HTTPError as HTTPClientError
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop, PeriodicCallback
+from concurrent.futures import ThreadPoolExecutor
 from tornado.web import HTTPError
-import sys
 import ast
+import socket
+from datetime import datetime, timedelta
 
+from jupyterhub import orm
 from jupyterhub.spawner import Spawner
 from .QueryUser import query_user
-from .marathon import Marathon
+from .marathon import AppRecord, Marathon
 from .GPUResourceAllocator import GPUResourceAllocator
+from .GPUDefragmenter import DefragmentationPlanner
+from .GPUTelemetry import GPUTelemetryCollector, utilization_source
+from .GPUInventory import MesosInventoryProvider
+from .AdmissionController import AdmissionCancelled, AdmissionController
+from .PlacementAffinity import PlacementAffinity
+from .QuotaTracker import QuotaTracker
+from .SpawnPredictor import SpawnPredictor
+from .SpawnTracer import SpawnTracer
+from .Teardown import bulk_teardown
+from .VolumePolicy import VolumePolicy, merge_volumes
+from .formextensions.mountedvolumes import MountedVolumesExtension
+from .formextensions.nvidiagpu import NvidiaGpuExtension
+from .formextensions.selectimage import SelectImageExtension
+from .UsageRecorder import MesosStatisticsSource, UsageRecorder
 
 
 class MarathonSpawner(Spawner):
@@ -40,11 +59,34 @@ class MarathonSpawner(Spawner):
         4096,
         help='Memory limit in MB',
         config=True)
+    cpus = Float(
+        1,
+        help='Number of CPUs reserved for a notebook server',
+        config=True)
+    usage_stats_urls = List([],
+        help='Mesos agent /monitor/statistics endpoints (or local JSON files) to record notebook usage from',
+        config=True)
+    usage_interval = Int(60,
+        help='Seconds between usage samples',
+        config=True)
+    usage_history_file = Unicode(u'',
+        help='JSON file the recorded usage histories are saved to, so they survive hub restarts',
+        config=True)
+    resource_profile_mode = Unicode(u'off',
+        help='Right-sizing from recorded usage: "off", "suggest" (only logs the profile) or "apply"',
+        config=True)
+    resource_profile_min_mem = Int(512,
+        help='Smallest memory limit in MB that right-sizing may apply, mem_limit is the largest',
+        config=True)
     volumes = List(
         [],
         help='Volumes to mount as Read-write. If a single string is entered then it is mounted in same path.'
              'If a tuple is specified then first item is hostPath and the 2nd is the containerPath',
         config=True)
+    allowed_volume_prefixes = List([],
+        help='Host path prefixes users may mount from the form, e.g. ["/data/shared", ["/data/home/{USERNAME}", "RW"], '
+             '["/data/readonly", "RO"]]. {USERNAME} and {USERID} are expanded per user. Empty allows no user mounts',
+        config=True)
     ports = List(
         [8888],
         help='Ports to expose externally',
@@ -56,8 +98,29 @@ class MarathonSpawner(Spawner):
                              help="Public IP address of the hub",
                              config=True)
     marathon_host = Unicode(u'',
-                            help="Hostname of Marathon server",
+                            help="Hostname of Marathon server (or a comma separated list of Marathon masters)",
                             config=True)
+    marathon_hosts = List([],
+                          help="URLs of all Marathon masters, takes precedence over marathon_host",
+                          config=True)
+    marathon_health_check_interval = Int(10,
+                                          help="Seconds between leader discovery and health checks of the Marathon masters",
+                                          config=True)
+    marathon_failover_cooldown = Int(30,
+                                     help="Seconds an unreachable Marathon master is skipped for",
+                                     config=True)
+    marathon_timeouts = Dict({},
+                             help="Read timeouts in seconds per Marathon operation (get, post, put, delete)",
+                             config=True)
+    marathon_max_retries = Int(3,
+                               help="Retries of idempotent Marathon requests that failed or were refused",
+                               config=True)
+    marathon_retry_budget = Float(10,
+                                  help="Seconds after the first attempt of a Marathon request in which retries may start",
+                                  config=True)
+    marathon_hedge_delay = Float(0,
+                                 help="Seconds after which a slow Marathon status read is sent again to another master, 0 disables it",
+                                 config=True)
     docker_image_name = Unicode(u'',
                                 help="Name of the docker image",
                                 config=True)
@@ -68,6 +131,175 @@ class MarathonSpawner(Spawner):
     num_gpus = Int(
         0,
         help='Number of GPUs to mount onto the machine')
+    gpu_shared = Bool(False,
+        help='Whether the GPUs for this server are shared with other users (set at runtime)'
+    )
+    gpu_hostname = Unicode(u'',
+        help='Host of the GPUs assigned to this server (set at runtime)'
+    )
+    gpu_ids = List([],
+        help='IDs of the GPUs assigned to this server (set at runtime)'
+    )
+    container_host = Unicode(u'',
+        help='Agent running the notebook server (set at runtime)'
+    )
+    container_ip = Unicode(u'',
+        help='IP address of the notebook server (set at runtime)'
+    )
+    container_port = Int(0,
+        help='Port of the notebook server (set at runtime)'
+    )
+    app_version = Unicode(u'',
+        help='Marathon version of the running app (set at runtime)'
+    )
+    trace_sample_rate = Float(1.0,
+        help='Fraction of spawns whose events are logged',
+        config=True)
+    trace_rate_limit = Float(20,
+        help='Maximum number of spawner events logged per second across the hub, 0 for no limit',
+        config=True)
+    trace_debug_users = List([],
+        help='Users whose spawner events are always logged, with request details',
+        config=True)
+    trace_debug_file = Unicode(u'',
+        help='File listing users (one per line) to put in debug mode while the hub runs',
+        config=True)
+    cull_idle_timeout = Int(0,
+        help='Seconds without activity after which a server is stopped, 0 disables culling',
+        config=True)
+    cull_gpu_idle_timeout = Int(0,
+        help='Seconds without activity after which a server holding GPUs is stopped, 0 uses cull_idle_timeout',
+        config=True)
+    cull_interval = Int(300,
+        help='Seconds between checks for idle servers',
+        config=True)
+    cull_concurrency = Int(10,
+        help='Number of idle servers stopped at the same time',
+        config=True)
+    marathon_max_deployments = Int(0,
+        help='Maximum number of Marathon deployments in flight across the hub, 0 for no limit. '
+             'Further spawns are queued, admins and returning users first',
+        config=True)
+    spawn_count = Int(0,
+        help='Number of times this user has spawned a server (persisted)'
+    )
+    container_mem_limit = Int(0,
+        help='Memory limit in MB the server was started with (set at runtime)'
+    )
+    user_gid = Unicode(u'',
+        help='Group ID of the user as returned by restuser, the group quotas are counted against (set at runtime)'
+    )
+    user_quota = Dict({},
+        help='Limits per user, e.g. {"gpus": 2, "mem": 16384, "servers": 1} (mem in MB), missing or 0 for no limit',
+        config=True)
+    group_quota = Dict({},
+        help='Limits per Unix group (gid from restuser), same format as user_quota',
+        config=True)
+    queue_position = Int(0,
+        help='Position in the deployment queue while waiting for admission, 0 when not queued'
+    )
+    marathon_health_check = Bool(True,
+        help='Add a Marathon HTTP health check on the notebook API to the app',
+        config=True)
+    readiness_initial_delay = Float(0.1,
+        help='First delay in seconds between readiness checks, later ones grow up to readiness_max_delay',
+        config=True)
+    readiness_max_delay = Float(2.0,
+        help='Longest delay in seconds between readiness checks',
+        config=True)
+    placement_affinity = Bool(False,
+        help='Prefer agents that recently ran the image or the user\'s last server (GPU servers are already pinned)',
+        config=True)
+    placement_affinity_timeout = Int(15,
+        help='Seconds Marathon gets to place a server on a preferred agent before the preference is dropped',
+        config=True)
+    bulk_teardown_concurrency = Int(16,
+        help='Number of Marathon deletes sent in parallel when many servers stop at once (e.g. hub shutdown)',
+        config=True)
+    bulk_teardown_group_delete = Bool(False,
+        help='At hub shutdown, delete the whole Marathon group with one forced request instead of app by app',
+        config=True)
+    marathon_snapshot_ttl = Int(10,
+        help='Seconds a listing of all notebook apps is reused by poll(), so a hub restart needs one Marathon request',
+        config=True)
+    allow_gpu_oversubscription = Bool(True,
+        help='Allow several users to share a single GPU when they request shared mode',
+        config=True)
+    gpu_capacity = Int(4,
+        help='Maximum number of users sharing a single GPU',
+        config=True)
+    shared_gpu_images = List([],
+        help='Images that run on shared GPUs unless exclusive mode is requested in the form',
+        config=True)
+    gpu_inventory_url = Unicode(u'',
+        help='Mesos master state endpoint (or local JSON file) to discover GPU hosts from, replaces resource_file_name when set',
+        config=True)
+    gpu_maintenance_url = Unicode(u'',
+        help='Mesos master maintenance status endpoint listing draining agents',
+        config=True)
+    gpu_inventory_interval = Int(60,
+        help='Seconds between refreshes of the GPU inventory',
+        config=True)
+    gpu_telemetry_url = Unicode(u'',
+        help='Path or URL of per-GPU utilization samples reported by the agents. Idle GPU reclamation is off when empty',
+        config=True)
+    gpu_telemetry_interval = Int(60,
+        help='Seconds between reads of the GPU utilization samples',
+        config=True)
+    gpu_telemetry_samples = Int(256,
+        help='Number of utilization samples kept per GPU, must cover gpu_idle_timeout',
+        config=True)
+    gpu_idle_timeout = Int(4 * 3600,
+        help='Seconds of low utilization after which a GPU allocation is considered idle',
+        config=True)
+    gpu_idle_utilization = Float(5.0,
+        help='Utilization (percent) below which a GPU counts as idle',
+        config=True)
+    gpu_idle_warning = Int(1800,
+        help='Seconds between the idle warning and the release of the allocation',
+        config=True)
+    gpu_idle_action = Unicode(u'flag',
+        help='What to do with idle GPU allocations: "flag" only logs them, "release" stops the server',
+        config=True)
+    prespawn_budget = Int(0,
+        help='Maximum number of servers started ahead of predicted logins at once, 0 disables pre-spawning',
+        config=True)
+    prespawn_lead = Int(600,
+        help='Seconds before a predicted login that its server is started',
+        config=True)
+    prespawn_min_probability = Float(0.6,
+        help='Fraction of recent days a user logged in around that time needed to pre-spawn their server',
+        config=True)
+    prespawn_unclaimed_timeout = Int(1800,
+        help='Seconds a pre-spawned server may stay unused before it is stopped',
+        config=True)
+    prespawn_gpus = Bool(False,
+        help='Also pre-spawn servers that use GPUs (they hold the GPUs while unclaimed)',
+        config=True)
+    prespawn_interval = Int(60,
+        help='Seconds between pre-spawn rounds',
+        config=True)
+    spawn_history_file = Unicode(u'',
+        help='JSON file the spawn history used to predict logins is saved to and restored from',
+        config=True)
+    defrag_action = Unicode(u'off',
+        help='GPU defragmentation: "off", "plan" only logs the moves that would free whole hosts, "apply" restarts the moved servers',
+        config=True)
+    defrag_hours = List([2, 3, 4, 5],
+        help='Hours of the day (hub local time) of the low usage window in which defragmentation runs',
+        config=True)
+    defrag_interval = Int(3600,
+        help='Seconds between defragmentation plans',
+        config=True)
+    defrag_restartable_images = List([],
+        help='Images whose single-GPU servers may be restarted elsewhere even when busy (idle ones always may)',
+        config=True)
+    defrag_target_host = Unicode(u'',
+        help='Host to move the single-GPU servers to, the fullest hosts with free GPUs when empty',
+        config=True)
+    defrag_max_moves = Int(4,
+        help='Maximum number of servers restarted per defragmentation run, 0 for no limit',
+        config=True)
 
     path_to_image_list = Unicode(u'',
         help='Path to image list (local path or URL)',
@@ -76,6 +308,9 @@ class MarathonSpawner(Spawner):
     runtime_constraints = List([],
         help='Constraints specified at runtime that will be appended to self.marathon_constraints'
     )
+    extra_extensions = List([],
+        help='Callables returning formextensions objects (called with the spawner on every spawn), whose prepare and modify_request steps run with the built-in ones',
+        config=True)
     runtime_vols = List([],
         help='Volumes specified at runtime that will be appended to self.volumes'
     )
@@ -83,12 +318,397 @@ class MarathonSpawner(Spawner):
         help='Environment variables specified at runtime (overrides vars with the same name)'
     )
 
+    # Hub-wide state shared by all spawners
+    _active_spawners = {}
+    _gpu_telemetry = None
+    _marathon_clients = {}
+    _gpu_allocators = {}
+    _background = ThreadPoolExecutor(max_workers=2)
+    # Blocking Marathon calls that should not hold up the IOLoop, e.g. deletes of many servers at once
+    _marathon_executor = ThreadPoolExecutor(max_workers=16)
+    # Blocking spawn preparation steps (user lookup, env_url fetch, GPU allocation) run concurrently here
+    _prepare_executor = ThreadPoolExecutor(max_workers=8)
+    _culler = None
+    _defragmenter = None
+    _quotas = None
+    _predictor = None
+    # username -> time the pre-spawned server came up (None while starting)
+    _prespawned = {}
+    # username -> time of the last pre-spawn, so an unclaimed server is not started again the same day
+    _prespawn_tried = {}
+    _admission = None
+    _volume_policy = None
+    _affinity = PlacementAffinity()
+    _pending_stops = {}
+    # Future of the teardown of every server at hub shutdown, started by the first stop()
+    _shutdown_teardown = None
+    # Users whose GPUs are released by the caller of their stop, e.g. all culled servers in one write
+    _deferred_releases = set()
+    _tracer = None
+    _usage_recorder = None
+    _progress_route_added = False
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # All traitlets configurables are configured by now
-        self.marathon = Marathon(self.marathon_host)
-        self.gpu_resources = GPUResourceAllocator(self.resource_file_name,
-                                                  self.status_file_name)
+        self.marathon = self._get_marathon_client()
+        self.gpu_resources = self._get_gpu_allocator()
+        if MarathonSpawner._tracer is None:
+            MarathonSpawner._tracer = SpawnTracer(self.log,
+                                                  sample_rate=self.trace_sample_rate,
+                                                  rate_limit=self.trace_rate_limit,
+                                                  debug_users=self.trace_debug_users,
+                                                  debug_file=self.trace_debug_file or None)
+        self.tracer = MarathonSpawner._tracer
+        self._reset_progress()
+        if MarathonSpawner._admission is None:
+            MarathonSpawner._admission = AdmissionController(self.marathon_max_deployments)
+        self.admission = MarathonSpawner._admission
+        if MarathonSpawner._volume_policy is None:
+            MarathonSpawner._volume_policy = VolumePolicy(self.allowed_volume_prefixes)
+        self.volume_policy = MarathonSpawner._volume_policy
+        if self.usage_stats_urls and MarathonSpawner._usage_recorder is None:
+            self._start_usage_recorder()
+        if (self.cull_idle_timeout or self.cull_gpu_idle_timeout) and MarathonSpawner._culler is None:
+            MarathonSpawner._culler = PeriodicCallback(self._cull_idle_servers, self.cull_interval * 1000)
+            MarathonSpawner._culler.start()
+        self.spawn_id = None
+        # Results of this spawn's preparation steps
+        self.prepared = {}
+        if self.gpu_telemetry_url and MarathonSpawner._gpu_telemetry is None:
+            self._start_gpu_telemetry()
+        if (self.user_quota or self.group_quota) and MarathonSpawner._quotas is None:
+            MarathonSpawner._quotas = QuotaTracker(self.user_quota, self.group_quota)
+        self.quotas = MarathonSpawner._quotas
+        if self.prespawn_budget and MarathonSpawner._predictor is None:
+            MarathonSpawner._predictor = SpawnPredictor(history_file=self.spawn_history_file or None)
+            PeriodicCallback(self._prespawn, self.prespawn_interval * 1000).start()
+        if self.defrag_action != 'off' and MarathonSpawner._defragmenter is None:
+            MarathonSpawner._defragmenter = DefragmentationPlanner(self.gpu_resources)
+            PeriodicCallback(self._defragment, self.defrag_interval * 1000).start()
+
+    def _get_marathon_client(self):
+        """
+        One client per set of masters for the whole hub, so leader and health information is shared
+        """
+        hosts = tuple(self.marathon_hosts) or self.marathon_host
+        if hosts not in MarathonSpawner._marathon_clients:
+            client = Marathon(hosts,
+                              health_check_interval=self.marathon_health_check_interval,
+                              failover_cooldown=self.marathon_failover_cooldown,
+                              timeouts=self.marathon_timeouts,
+                              max_retries=self.marathon_max_retries,
+                              retry_budget=self.marathon_retry_budget,
+                              hedge_delay=self.marathon_hedge_delay or None)
+            MarathonSpawner._marathon_clients[hosts] = client
+            if len(client.hosts) > 1:
+                # Pings and leader discovery run in the background, requests only read their results
+                def check_health():
+                    MarathonSpawner._background.submit(client.check_health)
+                check_health()
+                PeriodicCallback(check_health, self.marathon_health_check_interval * 1000).start()
+        return MarathonSpawner._marathon_clients[hosts]
+
+    def _get_gpu_allocator(self):
+        """
+        One allocator for the whole hub, so the discovered inventory is kept in memory once
+        """
+        key = (self.resource_file_name, self.status_file_name)
+        if key not in MarathonSpawner._gpu_allocators:
+            MarathonSpawner._gpu_allocators[key] = GPUResourceAllocator(self.resource_file_name,
+                                                                        self.status_file_name,
+                                                                        allow_oversubscription=self.allow_gpu_oversubscription,
+                                                                        gpu_capacity=self.gpu_capacity)
+            if self.gpu_inventory_url:
+                self._start_gpu_inventory(MarathonSpawner._gpu_allocators[key])
+        return MarathonSpawner._gpu_allocators[key]
+
+    def _start_gpu_inventory(self, gpu_resources):
+        provider = MesosInventoryProvider(self.gpu_inventory_url, maintenance_url=self.gpu_maintenance_url or None)
+
+        @gen.coroutine
+        def refresh():
+            try:
+                # Fetch off the IOLoop, apply on it
+                inventory = yield MarathonSpawner._background.submit(provider.fetch)
+            except Exception as e:
+                self.log.warning("Could not refresh GPU inventory from %s: %s", self.gpu_inventory_url, e)
+                return
+            changed = gpu_resources.update_inventory(inventory)
+            if changed:
+                self.log.info("GPU inventory changed for %s, drained: %s", ', '.join(changed),
+                              ', '.join(sorted(gpu_resources.drained_hosts)) or 'none')
+
+        # Blocking first fetch so the first spawn sees the cluster, later ones in the background
+        try:
+            gpu_resources.update_inventory(provider.fetch())
+        except Exception as e:
+            self.log.warning("Could not read GPU inventory from %s: %s", self.gpu_inventory_url, e)
+        PeriodicCallback(refresh, self.gpu_inventory_interval * 1000).start()
+
+    def _start_usage_recorder(self):
+        recorder = UsageRecorder(MesosStatisticsSource(self.usage_stats_urls),
+                                 min_mem=self.resource_profile_min_mem,
+                                 max_mem=self.mem_limit,
+                                 max_cpus=self.cpus,
+                                 history_file=self.usage_history_file or None)
+        MarathonSpawner._usage_recorder = recorder
+
+        @gen.coroutine
+        def collect():
+            # Marathon task IDs are the app ID with '/' replaced by '_', followed by '.<uuid>'
+            owners = {}
+            for spawner in list(MarathonSpawner._active_spawners.values()):
+                app_prefix = spawner.get_container_name().strip('/').replace('/', '_')
+                owners[app_prefix] = (spawner.user.name, spawner.docker_image_name)
+
+            def task_owner(task_id):
+                return owners.get(task_id.partition('.')[0])
+
+            try:
+                yield MarathonSpawner._background.submit(recorder.collect, task_owner)
+                if recorder.history_file:
+                    recorder.save()
+            except Exception as e:
+                self.log.warning("Could not record notebook usage: %s", e)
+
+        PeriodicCallback(collect, self.usage_interval * 1000).start()
+
+    def _resource_profile(self):
+        """
+        Memory limit and CPUs for this spawn, right-sized from the recorded usage when enabled
+        """
+        recorder = MarathonSpawner._usage_recorder
+        if recorder is None or self.resource_profile_mode == 'off':
+            return self.mem_limit, self.cpus
+        profile = recorder.suggest(self.user.name, self.docker_image_name)
+        if profile is None:
+            return self.mem_limit, self.cpus
+        self.tracer.event('resource_profile', self.user.name, self.spawn_id, mode=self.resource_profile_mode,
+                          mem_limit=profile[0], cpus=profile[1])
+        if self.resource_profile_mode != 'apply':
+            return self.mem_limit, self.cpus
+        return profile
+
+    def _idle_timeout(self, spawner):
+        if spawner.num_gpus > 0 and self.cull_gpu_idle_timeout:
+            return self.cull_gpu_idle_timeout
+        return self.cull_idle_timeout
+
+    @gen.coroutine
+    def _cull_idle_servers(self):
+        """
+        Stop every server idle for longer than its timeout. Last activity of all users is read with one query,
+        then the servers are stopped in parallel batches; the GPUs of the ones stopped are released together
+        with a single write at the end.
+        """
+        spawners = dict(MarathonSpawner._active_spawners)
+        if not spawners:
+            return
+        now = datetime.utcnow()
+        idle = []
+        for user in self.db.query(orm.User).filter(orm.User.name.in_(list(spawners))):
+            spawner = spawners[user.name]
+            if spawner.user.spawn_pending or spawner.user.stop_pending:
+                continue
+            timeout = self._idle_timeout(spawner)
+            if timeout and user.last_activity and (now - user.last_activity).total_seconds() > timeout:
+                idle.append(spawner)
+        if not idle:
+            return
+
+        self.log.info("Culling %i idle servers (%i holding GPUs)", len(idle),
+                      len([spawner for spawner in idle if spawner.gpu_ids]))
+
+        @gen.coroutine
+        def cull(spawner):
+            try:
+                yield self._stop_server(spawner.user)
+            except Exception as e:
+                self.log.error("Failed to cull idle server of %s: %s", spawner.user.name, e)
+                return None
+            return spawner.user.name
+
+        usernames = [spawner.user.name for spawner in idle]
+        # Their stops leave the GPUs allocated, released below
+        MarathonSpawner._deferred_releases.update(usernames)
+        stopped = []
+        try:
+            for i in range(0, len(idle), self.cull_concurrency):
+                results = yield [cull(spawner) for spawner in idle[i:i + self.cull_concurrency]]
+                stopped.extend(username for username in results if username)
+        finally:
+            MarathonSpawner._deferred_releases.difference_update(usernames)
+            if stopped:
+                self.gpu_resources.release_resources(stopped)
+
+    @gen.coroutine
+    def _stop_server(self, user):
+        """
+        Stop a user's server the way the hub's API does, removing the proxy route before the container
+        """
+        from jupyterhub.app import JupyterHub
+        yield JupyterHub.instance().proxy.delete_user(user)
+        yield user.stop()
+
+    def _start_gpu_telemetry(self):
+        MarathonSpawner._gpu_telemetry = GPUTelemetryCollector(utilization_source(self.gpu_telemetry_url),
+                                                               self.gpu_resources,
+                                                               samples_per_gpu=self.gpu_telemetry_samples,
+                                                               idle_timeout=self.gpu_idle_timeout,
+                                                               idle_utilization=self.gpu_idle_utilization,
+                                                               warning_period=self.gpu_idle_warning)
+        PeriodicCallback(self._check_idle_gpus, self.gpu_telemetry_interval * 1000).start()
+
+    @gen.coroutine
+    def _check_idle_gpus(self):
+        telemetry = MarathonSpawner._gpu_telemetry
+        try:
+            # Read off the IOLoop, the rings are only updated on it
+            samples = yield MarathonSpawner._background.submit(telemetry.source.read_samples)
+        except Exception as e:
+            self.log.warning("Could not read GPU telemetry from %s: %s", self.gpu_telemetry_url, e)
+            return
+        telemetry.ingest(samples)
+        to_warn, to_release = telemetry.check_idle()
+        for username in to_warn:
+            self.log.warning("GPUs of %s have been idle for %i seconds, they will be %s in %i seconds",
+                             username, self.gpu_idle_timeout,
+                             'released' if self.gpu_idle_action == 'release' else 'flagged',
+                             self.gpu_idle_warning)
+        for username in to_release:
+            spawner = MarathonSpawner._active_spawners.get(username)
+            if self.gpu_idle_action != 'release' or spawner is None:
+                self.log.warning("GPUs of %s are idle and could be released", username)
+                continue
+            self.log.warning("Stopping %s to release idle GPUs", username)
+            telemetry.forget(username)
+            try:
+                yield self._stop_server(spawner.user)
+            except Exception as e:
+                self.log.error("Failed to stop idle server of %s: %s", username, e)
+
+    @gen.coroutine
+    def _prespawn(self):
+        """
+        Stop pre-spawned servers nobody claimed, then start the servers of the users most likely to log in
+        within prespawn_lead seconds, up to prespawn_budget pre-spawned servers
+        """
+        from jupyterhub.app import JupyterHub
+        app = JupyterHub.instance()
+        predictor = MarathonSpawner._predictor
+        now = time.time()
+        for username, ready_at in list(MarathonSpawner._prespawned.items()):
+            if ready_at is None:
+                continue
+            spawner = MarathonSpawner._active_spawners.get(username)
+            orm_user = orm.User.find(self.db, username)
+            if spawner is None or orm_user is None:
+                del MarathonSpawner._prespawned[username]
+            elif orm_user.last_activity and orm_user.last_activity > datetime.utcfromtimestamp(ready_at):
+                del MarathonSpawner._prespawned[username]
+                predictor.record(username, spawner.docker_image_name, spawner.num_gpus)
+                self.log.info("Pre-spawned server of %s was claimed", username)
+            elif now - ready_at > self.prespawn_unclaimed_timeout:
+                self.log.info("Stopping unclaimed pre-spawned server of %s", username)
+                try:
+                    yield self._stop_server(app.users[orm_user])
+                    # Kept while the stop fails, so it is retried and still counts against the budget
+                    MarathonSpawner._prespawned.pop(username, None)
+                except Exception as e:
+                    self.log.error("Failed to stop pre-spawned server of %s: %s", username, e)
+        if predictor.history_file:
+            predictor.save()
+
+        budget = self.prespawn_budget - len(MarathonSpawner._prespawned)
+        for probability, username, image, num_gpus in predictor.predict(now + self.prespawn_lead):
+            if budget <= 0 or probability < self.prespawn_min_probability:
+                break
+            if (username in MarathonSpawner._active_spawners or username in MarathonSpawner._prespawned or
+                    now - MarathonSpawner._prespawn_tried.get(username, 0) < 12 * 3600 or
+                    (num_gpus and not self.prespawn_gpus)):
+                continue
+            orm_user = orm.User.find(self.db, username)
+            if orm_user is None:
+                continue
+            budget -= 1
+            MarathonSpawner._prespawned[username] = None
+            MarathonSpawner._prespawn_tried[username] = now
+            self.log.info("Pre-spawning %s for %s (%i GPUs), expected with probability %.2f",
+                          image, username, num_gpus, probability)
+            IOLoop.current().spawn_callback(self._prespawn_user, app, app.users[orm_user], image, num_gpus)
+
+    @gen.coroutine
+    def _prespawn_user(self, app, user, image, num_gpus):
+        try:
+            yield user.spawn(options=dict(image=image, num_gpus=num_gpus, prespawn=True))
+            yield app.proxy.add_user(user)
+            MarathonSpawner._prespawned[user.name] = time.time()
+        except Exception as e:
+            MarathonSpawner._prespawned.pop(user.name, None)
+            self.log.error("Failed to pre-spawn the server of %s: %s", user.name, e)
+
+    def _movable_users(self):
+        """
+        Users whose GPU servers may be restarted elsewhere: idle according to the GPU telemetry, or running a
+        restartable image
+        """
+        movable = set()
+        if MarathonSpawner._gpu_telemetry is not None:
+            movable.update(MarathonSpawner._gpu_telemetry.find_idle_users())
+        for username, spawner in MarathonSpawner._active_spawners.items():
+            if spawner.docker_image_name in self.defrag_restartable_images:
+                movable.add(username)
+        return movable
+
+    @gen.coroutine
+    def _defragment(self):
+        if datetime.now().hour not in self.defrag_hours:
+            return
+        freed_hosts, moves = MarathonSpawner._defragmenter.plan(self._movable_users(),
+                                                                target_host=self.defrag_target_host or None,
+                                                                max_moves=self.defrag_max_moves or None)
+        if not moves:
+            return
+        self.log.info("Defragmentation frees %s by moving %s", ', '.join(freed_hosts),
+                      ', '.join('%s (%s -> %s:%i)' % (username, from_host, to_host, gpu_id)
+                                for username, (from_host, to_host, gpu_id) in sorted(moves.items())))
+        if self.defrag_action != 'apply':
+            return
+        for username, (from_host, to_host, gpu_id) in sorted(moves.items()):
+            spawner = MarathonSpawner._active_spawners.get(username)
+            if spawner is None:
+                continue
+            try:
+                yield self._move_server(spawner, to_host, gpu_id)
+            except Exception as e:
+                self.log.error("Failed to move the server of %s to %s: %s", username, to_host, e)
+
+    @gen.coroutine
+    def _move_server(self, spawner, hostname, gpu_id):
+        """
+        Restart a single-GPU server on another GPU through the hub's stop and spawn, so the user's server,
+        state and proxy route are updated as for any restart
+        """
+        from jupyterhub.app import JupyterHub
+        user = spawner.user
+        container_name = spawner.get_container_name()
+        options = dict(spawner.user_options or {}, moved=True)
+        yield self._stop_server(user)
+        # The app ID can only be reused once Marathon removed the old app
+        deadline = time.time() + self.start_timeout
+        while time.time() < deadline:
+            status = yield MarathonSpawner._marathon_executor.submit(self.marathon.get_container_status,
+                                                                     container_name)
+            if status is None:
+                break
+            yield gen.sleep(1)
+        # The stop released the GPU, reserving the target makes the spawn's allocation return it
+        if not self.gpu_resources.move_allocations({user.name: (hostname, [gpu_id])}):
+            self.log.warning("GPU %i of %s was taken, %s restarts on any free GPU", gpu_id, hostname, user.name)
+        yield user.spawn(options=options)
+        yield JupyterHub.instance().proxy.add_user(user)
+        user.spawner.start_polling()
 
     def _expand_user_vars(self, string):
         """
@@ -96,29 +716,121 @@ class MarathonSpawner(Spawner):
 
         Currently expands:
           {USERNAME} -> Name of the user
-          {USERID} -> UserID
+          {USERID} -> UserID (looked up from restuser only when the string uses it)
         """
-        return string.format(
-            USERNAME=self.user.name,
-            USERID=self._user_id_default()
-        )
+        values = dict(USERNAME=self.user.name)
+        if '{USERID' in string:
+            values['USERID'] = self._user_id()
+        return string.format(**values)
 
     def get_state(self):
         state = super().get_state()
         state['container_name'] = self.get_container_name()
+        state['spawn_count'] = self.spawn_count
+        if self.container_ip:
+            state.update(dict(
+                ip=self.container_ip,
+                port=self.container_port,
+                host=self.container_host,
+                image=self.docker_image_name,
+                app_version=self.app_version,
+                num_gpus=self.num_gpus,
+                gpu_shared=self.gpu_shared,
+                gpu_hostname=self.gpu_hostname,
+                gpu_ids=self.gpu_ids,
+                mem_limit=self.container_mem_limit,
+                gid=self.user_gid,
+            ))
         return state
 
     def load_state(self, state):
-        if 'container_name' in state:
-            pass
+        super().load_state(state)
+        self.spawn_count = state.get('spawn_count', 0)
+        if 'ip' in state:
+            MarathonSpawner._active_spawners[self.user.name] = self
+            self.container_ip = state['ip']
+            self.container_port = state['port']
+            self.container_host = state.get('host', '')
+            self.docker_image_name = state.get('image', self.docker_image_name)
+            self.app_version = state.get('app_version', '')
+            self.num_gpus = state.get('num_gpus', 0)
+            self.gpu_shared = state.get('gpu_shared', False)
+            self.gpu_hostname = state.get('gpu_hostname', '')
+            self.gpu_ids = state.get('gpu_ids', [])
+            self.container_mem_limit = state.get('mem_limit', 0)
+            self.user_gid = state.get('gid', '')
+
+    def clear_state(self):
+        super().clear_state()
+        self.container_ip = ''
+        self.container_port = 0
+        self.container_host = ''
+        self.app_version = ''
+        self.gpu_hostname = ''
+        self.gpu_ids = []
+        self.container_mem_limit = 0
+
+    def _user_group(self):
+        """
+        Group ID of the user from restuser, looked up once
+        """
+        if not self.user_gid:
+            response = query_user(self.user.name) or {}
+            self.user_gid = str(response.get('gid', ''))
+        return self.user_gid or None
+
+    def _check_quota(self, mem_limit, charge=False):
+        """
+        Raise QuotaExceeded when a server of this size would take the user or their group over a quota
+        Args:
+            charge: Also count the server against the quotas
+        """
+        if self.quotas is None:
+            return
+        if charge:
+            self.quotas.charge(self.user.name, self._user_group(), self.num_gpus, mem_limit)
+        else:
+            self.quotas.check(self.user.name, self._user_group(), self.num_gpus, mem_limit)
      
+    def _admission_priority(self):
+        if self.user.admin:
+            return AdmissionController.ADMIN
+        if self.spawn_count:
+            return AdmissionController.RETURNING
+        return AdmissionController.NEW
+
+    @gen.coroutine
+    def _wait_for_admission(self, deadline):
+        """
+        Wait for a deployment slot, keeping queue_position up to date. Users still queued at the deadline
+        are removed from the queue.
+        """
+        admitted = self.admission.acquire(self.user.name, self._admission_priority())
+        while not admitted.done():
+            self.queue_position = self.admission.position(self.user.name) or 0
+            self.tracer.event('queued', self.user.name, self.spawn_id, position=self.queue_position,
+                              queue_length=self.admission.queue_length())
+            self._report_progress('queued', 'Waiting for a deployment slot, position %i in the queue' %
+                                  self.queue_position)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self.admission.cancel(self.user.name)
+                break
+            try:
+                yield gen.with_timeout(timedelta(seconds=min(5, remaining)), admitted,
+                                       quiet_exceptions=AdmissionCancelled)
+            except gen.TimeoutError:
+                pass
+        self.queue_position = 0
+        yield admitted
+
     def get_env(self):
         env = super().get_env()
         
         env.update(dict(
             # User Info
             USER=self.user.name,
-            USER_ID=str(self._user_id_default()),
+            USER_ID=str(self._user_id()),
             HOME='%s/%s/'%(self.home_basepath, self.user.name),
 
             # Container info
@@ -134,12 +846,7 @@ class MarathonSpawner(Spawner):
         ))
         
         if len(self.env_url) > 0:
-            # get content
-            try:
-                parsed_data = requests.get(self.env_url, verify=False).json()
-            except:
-                parsed_data = json.loads(open(self.env_url).read())
-
+            parsed_data = self.prepared['env_url'] if 'env_url' in self.prepared else self._fetch_env_url()
             for env_variable in parsed_data:
                 env[env_variable] = parsed_data[env_variable]
 
@@ -149,96 +856,555 @@ class MarathonSpawner(Spawner):
     def get_container_name(self):
         return '/%s/%s-notebook'%(self.marathon_group, self.user.name)
 
-    def _mount_nvidia(self, parameters, num_gpus):
-        # do nothing if no GPUs are requested
-        if num_gpus == 0:
-            pass
-        hostname, gpu_ids = self.gpu_resources.get_host_id(self.user.name, num_gpus)
-        driver_version = self.gpu_resources.get_driver_version(hostname)
-        self.runtime_constraints = [
-            ["hostname", "LIKE", hostname]
-        ]
-        parameters.extend([
-            {"key": "device", "value": "/dev/nvidiactl"},
-            {"key": "device", "value": "/dev/nvidia-uvm"},
-            {"key": "volume-driver", "value": "nvidia-docker"},
-            {"key": "volume", "value": "nvidia_driver_{}:/usr/local/nvidia:ro".format(driver_version)}
+    def _app_owner(self, app_id):
+        """
+        Username of a notebook app of this hub's group, None for other apps
+        """
+        prefix, suffix = '/%s/' % self.marathon_group, '-notebook'
+        if app_id.startswith(prefix) and app_id.endswith(suffix):
+            return app_id[len(prefix):-len(suffix)]
+        return None
+
+    def _user_id(self):
+        return self.prepared['uid'] if 'uid' in self.prepared else self._user_id_default()
+
+    def _fetch_env_url(self):
+        try:
+            return requests.get(self.env_url, verify=False).json()
+        except:
+            return json.loads(open(self.env_url).read())
+
+    def run_blocking(self, function, *args):
+        """
+        Run a blocking preparation step off the IOLoop, for extensions' prepare()
+        Returns:
+            A Future of its result
+        """
+        return MarathonSpawner._prepare_executor.submit(function, *args)
+
+    def _build_extensions(self):
+        """
+        The extensions taking part in this spawn, GPU allocation first. The image and the runtime volumes were
+        validated by options_from_form, their extensions put them into the request.
+        """
+        select_image = SelectImageExtension(self.path_to_image_list)
+        select_image.image = self.docker_image_name
+        # Runtime volumes whose container path is not mounted by the configured volumes already
+        runtime_volumes = merge_volumes(self.volumes, self.runtime_vols)[len(self.volumes):]
+        mounted_volumes = MountedVolumesExtension([
+            {"containerPath": container_path, "hostPath": host_path, "mode": mode}
+            for host_path, container_path, mode in runtime_volumes
+        ], self.volume_policy)
+        return ([NvidiaGpuExtension(self.gpu_resources), select_image, mounted_volumes] +
+                [factory(self) for factory in self.extra_extensions])
+
+    @gen.coroutine
+    def _prepare(self, extensions, fields):
+        """
+        Run the user lookup, the env_url fetch and the extensions' prepare() steps concurrently, so the
+        preparation takes as long as its slowest step
+        Args:
+            fields: Tracer fields the duration of every step is added to
+        """
+        @gen.coroutine
+        def timed(name, step, *args):
+            started = time.time()
+            try:
+                # Each step is yielded on its own, gen.multi then only waits on coroutines
+                result = yield step(*args)
+            finally:
+                fields['%s_ms' % name] = round((time.time() - started) * 1000, 1)
+            return result
+
+        steps = {'uid': (self.run_blocking, self._user_id_default)}
+        if self.env_url:
+            steps['env_url'] = (self.run_blocking, self._fetch_env_url)
+        for index, extension in enumerate(extensions):
+            if hasattr(extension, 'prepare'):
+                # By position, several extensions may be of the same class
+                steps['%s_%i' % (type(extension).__name__, index)] = (extension.prepare, self)
+        results = yield gen.multi(dict((name, timed(name, *step)) for name, step in steps.items()))
+        self.prepared.update((name, results[name]) for name in ('uid', 'env_url') if name in results)
+
+    # Share of the spawn done when each phase is reached, reported by the spawn-progress API
+    progress_phases = {
+        'queued': 5,
+        'uid_lookup': 10,
+        'gpu_allocation': 20,
+        'deployment_submitted': 30,
+        'task_staging': 45,
+        'image_pulling': 55,
+        'task_running': 75,
+        'not_ready': 90,
+        'ready': 100,
+        'failed': 100,
+    }
+
+    def _report_progress(self, phase, message):
+        """
+        Record a spawn phase for wait_for_progress(). A phase is reported once per spawn, except the queue position.
+        """
+        if phase != 'queued' and any(event['phase'] == phase for event in self._progress_events):
+            return
+        self._progress_events.append(dict(
+            progress=self.progress_phases[phase],
+            message=message,
+            phase=phase,
+            timestamp=time.time(),
+        ))
+        self._progress_changed.notify_all()
+
+    def _reset_progress(self):
+        if getattr(self, '_progress_changed', None) is not None:
+            # Clients waiting on the previous spawn's events see the new spawn_id
+            self._progress_changed.notify_all()
+        self._progress_events = []
+        self._progress_changed = locks.Condition()
+
+    @gen.coroutine
+    def wait_for_progress(self, since=0, timeout=30):
+        """
+        Progress events of the current spawn from the `since`-th on, waiting up to `timeout` seconds for one
+        when there are none yet and the spawn is not finished
+        """
+        events = self._progress_events
+        finished = events and events[-1]['phase'] in ('ready', 'failed')
+        if since >= len(events) and not finished:
+            yield self._progress_changed.wait(timeout=timedelta(seconds=timeout))
+        return self._progress_events[since:]
+
+    @classmethod
+    def _add_progress_route(cls):
+        """
+        JupyterHub 0.5 has no progress API for spawners, the hub's web application is extended with
+        SpawnProgressHandler once it exists
+        """
+        if cls._progress_route_added:
+            return
+        from jupyterhub.app import JupyterHub
+        app = JupyterHub.instance()
+        if getattr(app, 'tornado_application', None) is None:
+            return
+        from jupyterhub.utils import url_path_join
+        from .ProgressHandler import SpawnProgressHandler
+        app.tornado_application.add_handlers('.*$', [
+            (url_path_join(app.hub_prefix, 'api/users/([^/]+)/spawn-progress'), SpawnProgressHandler),
         ])
-        for gpu_id in gpu_ids:
-            parameters.append(
-                {"key": "device", "value": "/dev/nvidia%d" % gpu_id}
-            )
+        cls._progress_route_added = True
+
+    def _report_task_state(self, app, staging_since):
+        """
+        Report staging and image pulling from a status read the start loop made anyway.
+        Docker pulls the image while the task is staging, so a task staging for a few seconds is reported as pulling.
+        Returns:
+            When the task was first seen staging, None if it is not staging
+        """
+        if app is None or app.state not in ('TASK_STAGING', 'TASK_STARTING'):
+            return staging_since
+        now = time.time()
+        if staging_since is None:
+            self._report_progress('task_staging', 'Task staging on %s' % (app.host or 'an agent'))
+            return now
+        if now - staging_since >= 3:
+            self._report_progress('image_pulling', 'Pulling image %s' % self.docker_image_name)
+        return staging_since
+
+    def _backoff_delays(self):
+        """
+        Delays between checks: fast at first, growing by half each time up to readiness_max_delay
+        """
+        delay = self.readiness_initial_delay
+        while True:
+            yield delay
+            delay = min(self.readiness_max_delay, delay * 1.5)
+
+    def _health_checks(self):
+        if not self.marathon_health_check:
+            return None
+        return [{
+            "protocol": "HTTP",
+            "path": "%sapi" % self.user.server.base_url,
+            "portIndex": 0,
+            "gracePeriodSeconds": 300,
+            "intervalSeconds": 30,
+            "timeoutSeconds": 10,
+            "maxConsecutiveFailures": 3
+        }]
+
+    @gen.coroutine
+    def _wait_until_ready(self, ip, port, deadline):
+        """
+        Probe the notebook server's API until it answers or the deadline passes
+        Returns:
+            Number of probes until the server answered, None if it never did
+        """
+        client = AsyncHTTPClient()
+        url = 'http://%s:%i%sapi' % (ip, port, self.user.server.base_url)
+        delays = self._backoff_delays()
+        probes = 0
+        while time.time() < deadline:
+            probes += 1
+            try:
+                yield client.fetch(url, request_timeout=min(5, max(1, deadline - time.time())))
+                return probes
+            except HTTPClientError as e:
+                # 599 means no answer at all, any other status means the server is listening
+                if e.code != 599:
+                    return probes
+            except OSError:
+                pass
+            yield gen.sleep(next(delays))
+        return None
 
     @gen.coroutine
     def start(self):
-        print('HUB URI:', self.hub.api_url)
+        self._add_progress_route()
+        self._reset_progress()
+        try:
+            result = yield self._start()
+        except Exception as e:
+            if self.quotas is not None:
+                self.quotas.release(self.user.name)
+            self._report_progress('failed', 'Spawn failed: %s' % e)
+            raise
+        return result
+
+    @gen.coroutine
+    def _start(self):
+        self.spawn_id = self.tracer.new_spawn_id()
+        spawn_started = time.time()
         container_name = self.get_container_name()
+        MarathonSpawner._active_spawners[self.user.name] = self
+        if self.user_options.get('prespawn'):
+            self.docker_image_name = self.user_options['image']
+            self.num_gpus = self.user_options['num_gpus']
+            self.gpu_shared = self.docker_image_name in self.shared_gpu_images
+        elif MarathonSpawner._predictor is not None and not self.user_options.get('moved'):
+            MarathonSpawner._predictor.record(self.user.name, self.docker_image_name, self.num_gpus)
+        self.tracer.event('spawn_start', self.user.name, self.spawn_id, image=self.docker_image_name,
+                          num_gpus=self.num_gpus, hub_api_url=self.hub.api_url)
         self.runtime_constraints = self.marathon_constraints
         parameters = []
 
-        if self.num_gpus > 0:
-            self._mount_nvidia(parameters, self.num_gpus)
-        
-        parameters.append(
-            {"key": "workdir", "value": "%s/%s" % (self.work_dir, self.user.name)}
-        )
-
-        volumes = self.volumes + self.runtime_vols
-        #constraints = constraints + self.runtime_constraints
-
-        #print(constraints, file=sys.stderr, flush=True)
-        #print(parameters, file=sys.stderr, flush=True)
-        #print(volumes, file=sys.stderr, flush=True)
-        r = self.marathon.start_container(container_name,
-                          self.docker_image_name,
-                          self.cmd, #cmd,
-                          constraints=self.runtime_constraints,
-                          env=self.get_env(),
-                          parameters = parameters,
-                          mem_limit=self.mem_limit,
-                          volumes=volumes,
-                          ports=self.ports,
-                          network_mode=self.network_mode)
-        #print(r.text, file=sys.stderr, flush=True)
-
-        for i in range(self.start_timeout):
-            is_up = yield self.poll()
-            if is_up is None:
-                time.sleep(1)
-                ip, port = self.marathon.get_ip_and_port(container_name)
-                self.user.server.ip=ip
-                self.user.server.port = port
-                print('IP/PORT', ip, port)
-                return (ip, port)
-            time.sleep(1)
+        # Before anything is allocated, so a spawn waiting in the queue or cancelled from it holds nothing
+        mem_limit, cpus = self._resource_profile()
+        self._check_quota(mem_limit)
+        # The hub gives the whole spawn start_timeout seconds, queueing included
+        deadline = spawn_started + self.start_timeout
+        with self.tracer.phase('admission', self.user.name, self.spawn_id):
+            yield self._wait_for_admission(deadline)
+        submitted = False
+        try:
+            self._check_quota(mem_limit, charge=True)
+            self.container_mem_limit = mem_limit
 
-        return None
+            self.prepared = {}
+            extensions = self._build_extensions()
+            with self.tracer.phase('prepare', self.user.name, self.spawn_id, num_gpus=self.num_gpus) as fields:
+                yield self._prepare(extensions, fields)
+
+            env = self.get_env()
+            self._report_progress('uid_lookup', 'Looked up user ID %s' % env['USER_ID'])
+
+            if self.num_gpus > 0:
+                self.gpu_hostname, self.gpu_ids = extensions[0].hostname, extensions[0].gpu_ids
+                self._report_progress('gpu_allocation', 'Assigned GPUs %s on %s' %
+                                      (', '.join(map(str, self.gpu_ids)), self.gpu_hostname))
+
+            # Constraints of the request as submitted, extensions add their own
+            submitted_constraints = []
+
+            def modify_request(docker_container, app_container, app_request):
+                for extension in extensions:
+                    extension.modify_request(docker_container, app_container, app_request, self)
+                submitted_constraints[:] = app_request.constraints
+
+            parameters.append(
+                {"key": "workdir", "value": "%s/%s" % (self.work_dir, self.user.name)}
+            )
+
+            # Runtime volumes are added by MountedVolumesExtension
+            volumes = self.volumes
+
+            preference = None
+            if self.placement_affinity and self.num_gpus == 0:
+                preference = self._affinity.constraint(self.user.name, self.docker_image_name)
+                if preference:
+                    self.runtime_constraints = self.runtime_constraints + [preference]
+                    self.tracer.event('placement_preference', self.user.name, self.spawn_id, hosts=preference[2])
+            #constraints = constraints + self.runtime_constraints
+
+            self.spawn_count += 1
+            # Marathon may have created the app even if the request fails
+            submitted = True
+            with self.tracer.phase('deployment_submitted', self.user.name, self.spawn_id) as fields:
+                # Retries back off with time.sleep, Marathon calls stay off the IOLoop
+                r = yield MarathonSpawner._marathon_executor.submit(self.marathon.start_container,
+                                  container_name,
+                                  self.docker_image_name,
+                                  self.cmd, #cmd,
+                                  constraints=self.runtime_constraints,
+                                  env=env,
+                                  parameters = parameters,
+                                  mem_limit=mem_limit,
+                                  cpus=cpus,
+                                  volumes=volumes,
+                                  ports=self.ports,
+                                  network_mode=self.network_mode,
+                                  health_checks=self._health_checks(),
+                                  modify_request=modify_request)
+                if r:
+                    self.app_version = r.get('version', '')
+                fields['app_version'] = self.app_version
+            # Placement is only waited for from here, not while queued or preparing
+            submitted_at = time.time()
+            self._report_progress('deployment_submitted', 'Submitted server to Marathon')
+            # Environment values may hold secrets, only their names are traced
+            self.tracer.event('marathon_request', self.user.name, self.spawn_id,
+                              debug=dict(constraints=self.runtime_constraints, parameters=parameters,
+                                         volumes=merge_volumes(volumes, self.runtime_vols),
+                                         mem_limit=mem_limit, cpus=cpus, env_keys=sorted(env)))
+
+            ip = None
+            with self.tracer.phase('task_running', self.user.name, self.spawn_id) as fields:
+                delays = self._backoff_delays()
+                polls = 0
+                staging_since = None
+                while time.time() < deadline:
+                    polls += 1
+                    container_info = yield MarathonSpawner._marathon_executor.submit(self.marathon.get_container_status,
+                                                                                     container_name)
+                    app = AppRecord.from_app(container_info) if container_info else None
+                    staging_since = self._report_task_state(app, staging_since)
+                    if self._is_running(app):
+                        ip, port = self._update_location(app)
+                        self.marathon.invalidate_snapshot(self.marathon_group)
+                        self._affinity.record(self.user.name, self.docker_image_name, self.container_host)
+                        fields.update(host=self.container_host, port=port)
+                        self._report_progress('task_running', 'Server running on %s, waiting for it to answer' %
+                                              self.container_host)
+                        break
+                    if preference and time.time() - submitted_at > self.placement_affinity_timeout:
+                        # Preferred agents are full, let Marathon place the server anywhere. The update replaces
+                        # all the constraints, the ones extensions added are sent again.
+                        self.runtime_constraints = [c for c in self.runtime_constraints if c is not preference]
+                        if preference in submitted_constraints:
+                            submitted_constraints.remove(preference)
+                        preference = None
+                        yield MarathonSpawner._marathon_executor.submit(self.marathon.update_constraints, container_name,
+                                                                        submitted_constraints)
+                        fields['preference_dropped'] = True
+                    yield gen.sleep(next(delays))
+                fields['polls'] = polls
+            # The deployment is done, let the next queued spawn in
+            self.admission.release(self.user.name)
+
+            # JupyterHub 0.5 ignores what start() returns, a spawn that did not come up has to raise
+            if not ip:
+                self._trace_timeout(spawn_started)
+                raise gen.TimeoutError("Server was not running after %i seconds" % self.start_timeout)
+            with self.tracer.phase('readiness_probe', self.user.name, self.spawn_id) as fields:
+                fields['probes'] = yield self._wait_until_ready(ip, port, deadline)
+            if not fields['probes']:
+                self._report_progress('not_ready', 'Server is running but did not answer within %i seconds' %
+                                      self.start_timeout)
+                self._trace_timeout(spawn_started)
+                raise gen.TimeoutError("Server did not answer within %i seconds" % self.start_timeout)
+        except Exception:
+            # Already done when the deployment finished
+            self.admission.release(self.user.name)
+            # Once submitted, the app has to be gone before its GPUs are given back
+            if not submitted or (yield self._remove_app(container_name)):
+                self._forget_server()
+            raise
+
+        self._report_progress('ready', 'Server is ready')
+        self.tracer.event('spawn_done', self.user.name, self.spawn_id,
+                          duration_ms=round((time.time() - spawn_started) * 1000, 1))
+        return (ip, port)
+
+    def _trace_timeout(self, spawn_started):
+        self.tracer.event('spawn_timeout', self.user.name, self.spawn_id,
+                          duration_ms=round((time.time() - spawn_started) * 1000, 1))
+
+    @gen.coroutine
+    def _remove_app(self, container_name):
+        """
+        Delete the app of a server the hub will not call stop() for (the hub only stops servers poll() reports
+        alive), e.g. of a spawn that failed after it was submitted
+        Returns:
+            Whether the app is gone, an app that could not be deleted may still hold its GPUs
+        """
+        failed = yield MarathonSpawner._marathon_executor.submit(self.marathon.stop_containers, [container_name])
+        self.marathon.invalidate_snapshot(self.marathon_group)
+        if failed:
+            self.log.error("Failed to remove the server of %s: %s", self.user.name, failed[container_name])
+            return False
+        return True
 
     @gen.coroutine
     def stop(self):
-        container_name = self.get_container_name()
-        self.marathon.stop_container(container_name)
-        self.gpu_resources.release_resource(self.user.name)
+        """
+        Stops issued in the same IOLoop iteration are torn down together: parallel deletes and a single write of
+        the GPU allocations. At hub shutdown the first stop() tears down every running server at once, the hub
+        stops the servers one by one, each after a poll.
+        """
+        self.admission.cancel(self.user.name)
+        if self._hub_shutting_down():
+            if MarathonSpawner._shutdown_teardown is None:
+                MarathonSpawner._shutdown_teardown = self._teardown_all()
+            usernames, failed = yield MarathonSpawner._shutdown_teardown
+            if self.user.name in failed:
+                raise ValueError(failed[self.user.name])
+            if self.user.name in usernames:
+                return
+        stopped = Future()
+        if not MarathonSpawner._pending_stops:
+            IOLoop.current().add_callback(self._flush_stops)
+        MarathonSpawner._pending_stops[self.user.name] = (self, stopped)
+        yield stopped
+
+    @staticmethod
+    def _hub_shutting_down():
+        from jupyterhub.app import JupyterHub
+        # Set by the hub before its cleanup stops the servers
+        return getattr(JupyterHub.instance(), '_atexit_ran', False)
+
+    @gen.coroutine
+    def _flush_stops(self):
+        pending, MarathonSpawner._pending_stops = MarathonSpawner._pending_stops, {}
+        failed = yield self._teardown(dict((username, spawner.get_container_name())
+                                           for username, (spawner, stopped) in pending.items()))
+        for username, (spawner, stopped) in pending.items():
+            if username in failed:
+                stopped.set_exception(ValueError(failed[username]))
+            else:
+                stopped.set_result(None)
+
+    @gen.coroutine
+    def _teardown_all(self):
+        """
+        Tear down every running server for the hub's shutdown, with one group delete if enabled
+        Returns:
+            usernames: The users whose servers were torn down
+            failed: A dictionary of the format {username:error}
+        """
+        container_names = dict((username, spawner.get_container_name())
+                               for username, spawner in MarathonSpawner._active_spawners.items())
+        group_delete = self.bulk_teardown_group_delete and len(container_names) > 1
+        failed = yield self._teardown(container_names, group_delete=group_delete, check_remaining=True)
+        return set(container_names), failed
+
+    @gen.coroutine
+    def _teardown(self, container_names, group_delete=False, check_remaining=False):
+        """
+        Delete the apps of many servers, release their GPUs with a single write and stop tracking them
+        Args:
+            container_names: A dictionary of the format {username:container_name}
+            check_remaining: List the group afterwards to log the apps Marathon is still removing
+
+        Returns:
+            failed: A dictionary of the format {username:error} of the servers that could not be deleted
+        """
+        try:
+            failed, remaining = yield MarathonSpawner._marathon_executor.submit(
+                bulk_teardown, self.marathon, self.marathon_group, container_names, self.gpu_resources,
+                max_workers=self.bulk_teardown_concurrency, group_delete=group_delete,
+                keep=MarathonSpawner._deferred_releases & set(container_names), check_remaining=check_remaining)
+        except Exception as e:
+            failed, remaining = dict((name, str(e)) for name in container_names.values()), []
+
+        for username, name in container_names.items():
+            if name not in failed:
+                MarathonSpawner._active_spawners.pop(username, None)
+                if self.quotas is not None:
+                    self.quotas.release(username)
+        if len(container_names) > 1 or failed or remaining:
+            self.log.info("Stopped %i servers%s", len(container_names) - len(failed),
+                          ' (group delete)' if group_delete else '')
+        if failed:
+            self.log.warning("Failed to stop: %s", ', '.join(sorted(failed)))
+        if remaining:
+            self.log.warning("Still being removed by Marathon: %s", ', '.join(remaining))
+        return dict((username, failed[name]) for username, name in container_names.items() if name in failed)
 
     @gen.coroutine
     def get_ip_and_port(self):
         container_name = self.get_container_name()
-        print('IP/PORT: {}'.format(self.marathon.get_ip_and_port(container_name)))
-        return self.marathon.get_ip_and_port(container_name)
+        ip_and_port = yield MarathonSpawner._marathon_executor.submit(self.marathon.get_ip_and_port, container_name)
+        self.tracer.event('ip_and_port', self.user.name, self.spawn_id, location=ip_and_port)
+        return ip_and_port
+
+    @staticmethod
+    def _is_running(app):
+        if app is None or app.tasks != 1:
+            return False
+        # Staged tasks are listed too, before they have ports
+        return app.state == 'TASK_RUNNING'
+
+    def _update_location(self, app):
+        """
+        Record where the app's task runs. The hostname is only resolved again when the task moved.
+        """
+        if app.host != self.container_host or not self.container_ip:
+            self.container_host = app.host
+            self.container_ip = socket.gethostbyname(app.host)
+        self.container_port = app.port
+        self.app_version = app.version or self.app_version
+        server = self.user.server
+        if server is not None and (server.ip != self.container_ip or server.port != self.container_port):
+            self.user.server.ip = self.container_ip
+            self.user.server.port = self.container_port
+        return self.container_ip, self.container_port
 
     @gen.coroutine
     def poll(self):
-        container_info = self.marathon.get_container_status(self.get_container_name())
-        print(container_info, file=sys.stderr, flush=True)
-
-        if container_info is None:
+        container_name = self.get_container_name()
+        try:
+            # Shared listing of the whole group, so polling every user after a restart costs one request
+            apps = yield MarathonSpawner._marathon_executor.submit(self.marathon.get_app_snapshot, self.marathon_group,
+                                                                   max_age=self.marathon_snapshot_ttl)
+            if self.placement_affinity:
+                self._affinity.reconcile(apps, self._app_owner)
+            app = apps.get(container_name)
+        except ValueError:
+            container_info = yield MarathonSpawner._marathon_executor.submit(self.marathon.get_container_status,
+                                                                             container_name)
+            app = AppRecord.from_app(container_info) if container_info else None
+        if app is None:
+            self.tracer.event('poll', self.user.name, self.spawn_id, state='missing')
+            self._forget_server()
             return ""
 
-        if 'tasks' in container_info and len(container_info['tasks']) == 1:
+        if self._is_running(app):
+            self._update_location(app)
+            if self.quotas is not None and self.user.name not in self.quotas.holdings:
+                # Servers restored from the database count against the quotas once they are known to run
+                self.quotas.charge(self.user.name, self.user_gid or None, self.num_gpus, self.container_mem_limit,
+                                   check=False)
             return None
-        else:
-            print('Container Not Found')
-            return ""
+        if app.tasks or app.deployments:
+            # Staging (e.g. pulling the image) or being deployed: the app holds its GPUs, so it has to be reported
+            # alive for the hub to call stop() when the spawn is given up on
+            return None
+        self.tracer.event('poll', self.user.name, self.spawn_id, state='no_task',
+                          tasks=app.tasks, version=app.version)
+        # Marathon could launch the task again on GPUs given to someone else, the app goes with its allocation
+        removed = yield self._remove_app(container_name)
+        if removed:
+            self._forget_server()
+        return ""
+
+    def _forget_server(self):
+        """
+        Stop tracking a server whose app is gone and give back its quota and GPUs. The hub does not call
+        stop() for servers poll() finds dead.
+        """
+        if MarathonSpawner._active_spawners.get(self.user.name) is self:
+            del MarathonSpawner._active_spawners[self.user.name]
+        if self.quotas is not None:
+            self.quotas.release(self.user.name)
+        self.gpu_resources.release_resource(self.user.name)
 
     def _user_id_default(self):
         """
@@ -250,24 +1416,10 @@ class MarathonSpawner(Spawner):
         return response['uid']
 
     def get_image_list(self):
-        image_list = []
-        #print(self.path_to_image_list, file=sys.stderr, flush=True)
-        if os.path.exists(self.path_to_image_list):
-            with open(self.path_to_image_list) as f:
-                image_list = f.readlines()
-        else:
-            r = requests.get(self.path_to_image_list)
-            image_list = r.text.split("\n")
-        image_list = [line.strip().split(",") for line in image_list if line]
-        #print(image_list, file=sys.stderr, flush=True)
-        return image_list
+        return SelectImageExtension(self.path_to_image_list).get_image_list()
 
     def get_image_form(self):
-        html = "<select name=\"image\">"
-        for display_name, value in self.get_image_list():
-            html += "<option value=\"%s\">%s</option>" % (value, display_name)
-        html += "</select>"
-        return html
+        return SelectImageExtension(self.path_to_image_list).options_form(self)
 
     def _options_form_default(self):
         defaults = {
@@ -292,6 +1444,13 @@ class MarathonSpawner(Spawner):
             <option value="2">2</option>
         </select>
 
+        <label for="gpu_mode">GPU mode:</label>
+        <select name="gpu_mode">
+            <option value="">Image default</option>
+            <option value="exclusive">Exclusive</option>
+            <option value="shared">Shared</option>
+        </select>
+
         <label for="vols">Mounted volumes:</label>
         <input type="text" name="vols" placeholder="{vols}"/>
 
@@ -317,9 +1476,21 @@ class MarathonSpawner(Spawner):
         if options['num_gpus']:
             self.num_gpus = int(''.join(formdata['num_gpus']))
 
+        options['gpu_mode'] = ''.join(formdata.get('gpu_mode', []))
+        if options['gpu_mode']:
+            self.gpu_shared = options['gpu_mode'] == 'shared'
+        else:
+            self.gpu_shared = self.docker_image_name in self.shared_gpu_images
+
         options['volumes'] = ''.join(formdata['vols'])
         if options['volumes']:
-            self.runtime_volumes = ast.literal_eval(options['volumes'])
+            try:
+                requested = ast.literal_eval(options['volumes'])
+            except (ValueError, SyntaxError):
+                raise ValueError("Invalid volumes specified.")
+            if not isinstance(requested, (list, tuple)):
+                requested = [requested]
+            self.runtime_vols = self.volume_policy.validate(requested, self._expand_user_vars)
 
         options['runtime_envs'] = ''.join(formdata['runtime_envs'])
         runtime_envs = {}
@@ -332,5 +1503,7 @@ class MarathonSpawner(Spawner):
         if runtime_envs:
             self.runtime_envs = runtime_envs
 
+        # Checked here so the form shows the error, charged in start()
+        self._check_quota(self._resource_profile()[0])
         return options
 
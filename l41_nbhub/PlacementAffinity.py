@@ -0,0 +1,71 @@
+from collections import OrderedDict
+import re
+import time
+
+
+class PlacementAffinity:
+    """
+    Remembers which agents recently ran each image and where each user's server last ran, to steer new
+    notebooks to agents with a warm image cache (and the user's local scratch data).
+    Marathon constraints are hard, so the preference is a hostname constraint that the spawner drops again
+    when Marathon cannot place the app on any preferred agent in time.
+    """
+    def __init__(self, hosts_per_image=5, max_age=7 * 24 * 3600):
+        """
+        Args:
+            hosts_per_image: Number of most recent agents remembered per image
+            max_age: Seconds after which an agent is no longer assumed to have the image cached
+        """
+        self.hosts_per_image = hosts_per_image
+        self.max_age = max_age
+        self.image_hosts = {}
+        self.user_hosts = {}
+        self.reconciled = None
+
+    def record(self, username, image, host, timestamp=None):
+        timestamp = timestamp or time.time()
+        self.user_hosts[username] = host
+        hosts = self.image_hosts.setdefault(image, OrderedDict())
+        hosts.pop(host, None)
+        hosts[host] = timestamp
+        while len(hosts) > self.hosts_per_image:
+            hosts.popitem(last=False)
+
+    def reconcile(self, apps, owner):
+        """
+        Learn placements from a Marathon listing of apps with their tasks. The same listing is only read once.
+        Args:
+            apps: A dictionary of the format {app_id:AppRecord}
+            owner: Function mapping an app ID to a username, or None for apps that are not notebooks
+        """
+        if apps is self.reconciled:
+            return
+        self.reconciled = apps
+        now = time.time()
+        for app_id, app in apps.items():
+            username = owner(app_id)
+            if app.image and username and app.host:
+                self.record(username, app.image, app.host, now)
+
+    def preferred_hosts(self, username, image):
+        """
+        Agents to prefer, the user's last agent first, then the agents that ran the image most recently
+        """
+        now = time.time()
+        hosts = []
+        if username in self.user_hosts:
+            hosts.append(self.user_hosts[username])
+        for host, seen in reversed(list(self.image_hosts.get(image, {}).items())):
+            if now - seen <= self.max_age and host not in hosts:
+                hosts.append(host)
+        return hosts
+
+    def constraint(self, username, image):
+        """
+        Returns:
+            A Marathon hostname constraint matching the preferred agents, None without any
+        """
+        hosts = self.preferred_hosts(username, image)
+        if not hosts:
+            return None
+        return ["hostname", "LIKE", '|'.join(re.escape(host) for host in hosts)]
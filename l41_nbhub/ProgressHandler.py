@@ -0,0 +1,39 @@
+import json
+
+from tornado import gen, web
+from jupyterhub.apihandlers.base import APIHandler
+
+
+class SpawnProgressHandler(APIHandler):
+    """
+    Progress events of a user's current spawn and their position in the deployment queue (0 when not
+    queued), for users and admins:
+
+        GET /hub/api/users/<name>/spawn-progress?since=<number of events already seen>
+
+    Answers as soon as there are events after `since`, or after `timeout` seconds (long polling).
+    """
+    timeout = 30
+
+    @web.authenticated
+    @gen.coroutine
+    def get(self, name):
+        current_user = self.get_current_user()
+        if current_user.name != name and not current_user.admin:
+            raise web.HTTPError(403)
+        user = self.find_user(name)
+        if user is None or user.spawner is None:
+            raise web.HTTPError(404)
+        try:
+            since = max(0, int(self.get_argument('since', '0')))
+        except ValueError:
+            raise web.HTTPError(400, "since must be a number of events")
+        spawner = user.spawner
+        events = yield spawner.wait_for_progress(since, self.timeout)
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({
+            'spawn_id': spawner.spawn_id,
+            'pending': bool(user.spawn_pending),
+            'queue_position': spawner.queue_position,
+            'events': events,
+        }))
@@ -1,6 +1,7 @@
 import os
 import json
 import socket
+import threading
 
 from tornado import gen
 from tornado.httpclient import HTTPClient, HTTPError
@@ -26,10 +27,13 @@ class UnixResolver(Resolver):
 
 resolver = UnixResolver(resolver=Resolver(), socket_path=SOCKET_PATH)
 client = HTTPClient(resolver=resolver)
+# The synchronous client runs its own IOLoop and cannot be used from several threads at once
+client_lock = threading.Lock()
 
 def query_user(name):
     try:
-       resp = client.fetch('http://unix+restuser/' + name, method='POST', body='{}')
+        with client_lock:
+            resp = client.fetch('http://unix+restuser/' + name, method='POST', body='{}')
     except HTTPError as e:
         print(e.response.code, e.response.body.decode('utf8', 'replace'))
         return
@@ -0,0 +1,88 @@
+class QuotaExceeded(ValueError):
+    """
+    Raised when a spawn would take a user or their group over a quota
+    """
+
+
+class QuotaTracker:
+    """
+    Per-user and per-group usage counters (GPUs, memory in MB, running servers), updated when a server is
+    charged or released so a quota check never has to scan the allocations.
+    """
+    resources = ('gpus', 'mem', 'servers')
+
+    def __init__(self, user_limits=None, group_limits=None):
+        """
+        Args:
+            user_limits: A dictionary of the format {resource:limit} applied to every user, missing or 0 for no limit
+            group_limits: A dictionary of the format {resource:limit} applied to every group
+        """
+        for limits in (user_limits or {}, group_limits or {}):
+            for resource in limits:
+                if resource not in self.resources:
+                    raise ValueError("Unknown quota resource %s, expected one of %s." %
+                                     (resource, ', '.join(self.resources)))
+        self.user_limits = user_limits or {}
+        self.group_limits = group_limits or {}
+        # key -> {resource:amount}, keys are ('user', name) and ('group', gid)
+        self.usage = {}
+        # username -> (gid, {resource:amount}) of what the user is charged for
+        self.holdings = {}
+
+    def used(self, kind, name, resource):
+        return self.usage.get((kind, name), {}).get(resource, 0)
+
+    def check(self, username, group, gpus, mem):
+        """
+        Raise QuotaExceeded if charging the user for a server would exceed a quota. What the user already
+        holds is not counted twice, so a server can be restarted at the same size.
+        """
+        amounts = dict(gpus=gpus, mem=mem, servers=1)
+        held = self.holdings.get(username)
+        for kind, name, limits in (('user', username, self.user_limits), ('group', group, self.group_limits)):
+            if name is None:
+                continue
+            for resource, limit in limits.items():
+                if not limit:
+                    continue
+                used = self.used(kind, name, resource)
+                if held and (kind == 'user' or held[0] == name):
+                    used -= held[1][resource]
+                if used + amounts[resource] > limit:
+                    raise QuotaExceeded("%s quota of %s %s exceeded: %s in use, %s requested." %
+                                        (resource, kind, name, used, amounts[resource]))
+
+    def charge(self, username, group, gpus, mem, check=True):
+        """
+        Count a server against the user's and group's quotas, replacing what the user was charged for before
+        Args:
+            check: Raise QuotaExceeded instead of charging when a quota would be exceeded
+        """
+        if check:
+            self.check(username, group, gpus, mem)
+        self.release(username)
+        amounts = dict(gpus=gpus, mem=mem, servers=1)
+        self.holdings[username] = (group, amounts)
+        for key in (('user', username), ('group', group)):
+            if key[1] is None:
+                continue
+            usage = self.usage.setdefault(key, {})
+            for resource, amount in amounts.items():
+                usage[resource] = usage.get(resource, 0) + amount
+
+    def release(self, username):
+        """
+        Give back what a user is charged for, does nothing if they hold nothing
+        """
+        held = self.holdings.pop(username, None)
+        if held is None:
+            return
+        group, amounts = held
+        for key in (('user', username), ('group', group)):
+            usage = self.usage.get(key)
+            if usage is None:
+                continue
+            for resource, amount in amounts.items():
+                usage[resource] -= amount
+            if not usage['servers']:
+                del self.usage[key]
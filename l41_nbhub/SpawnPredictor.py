@@ -0,0 +1,83 @@
+from collections import Counter, deque
+from datetime import date
+import json
+import os
+import time
+
+
+class SpawnPredictor:
+    """
+    Predicts logins from each user's spawn history. The probability that a user spawns around a time of day
+    is the fraction of the days they have been seen on (up to `days`) with a spawn within `tolerance` seconds
+    of that time of day. The image and number of GPUs predicted are the most common ones of those spawns.
+    """
+    def __init__(self, history_size=64, days=14, tolerance=1800, min_days=3, history_file=None):
+        """
+        Args:
+            history_size: Number of spawns kept per user
+            days: Number of past days looked at
+            tolerance: Seconds around the time of day that count as the same login time
+            min_days: Days of history needed before a user is predicted
+            history_file: JSON file the histories are saved to and restored from
+        """
+        self.history_size = history_size
+        self.days = days
+        self.tolerance = tolerance
+        self.min_days = min_days
+        self.history_file = history_file
+        # username -> deque of (timestamp, image, num_gpus)
+        self.histories = {}
+        if history_file and os.path.exists(history_file):
+            self.load()
+
+    def record(self, username, image, num_gpus, timestamp=None):
+        timestamp = timestamp or time.time()
+        if username not in self.histories:
+            self.histories[username] = deque(maxlen=self.history_size)
+        self.histories[username].append((timestamp, image, num_gpus))
+
+    @staticmethod
+    def _time_of_day(timestamp):
+        local = time.localtime(timestamp)
+        return local.tm_hour * 3600 + local.tm_min * 60 + local.tm_sec
+
+    def _near(self, timestamp, time_of_day):
+        distance = abs(self._time_of_day(timestamp) - time_of_day)
+        return min(distance, 86400 - distance) <= self.tolerance
+
+    def predict(self, at):
+        """
+        Users likely to spawn around `at`, leaving out those who spawned within the last 2 * tolerance
+        seconds before it (they already logged in)
+        Returns:
+            predictions: A list of tuples of (probability, username, image, num_gpus), most likely first
+        """
+        time_of_day = self._time_of_day(at)
+        predictions = []
+        for username, history in self.histories.items():
+            recent = [entry for entry in history if at - entry[0] <= self.days * 86400]
+            if not recent or at - recent[-1][0] <= 2 * self.tolerance:
+                continue
+            # Whole days since the first recent spawn, the day of `at` is still to come
+            observed_days = min(self.days, (date.fromtimestamp(at) - date.fromtimestamp(recent[0][0])).days)
+            if observed_days < self.min_days:
+                continue
+            matches = [entry for entry in recent if self._near(entry[0], time_of_day)]
+            matching_days = len(set(date.fromtimestamp(entry[0]) for entry in matches))
+            if not matching_days:
+                continue
+            (image, num_gpus), count = Counter((entry[1], entry[2]) for entry in matches).most_common(1)[0]
+            predictions.append((min(1.0, float(matching_days) / observed_days), username, image, num_gpus))
+        return sorted(predictions, key=lambda prediction: (-prediction[0], prediction[1]))
+
+    def save(self):
+        data = dict((username, list(history)) for username, history in self.histories.items())
+        with open(self.history_file, 'w') as fOut:
+            json.dump(data, fOut)
+
+    def load(self):
+        with open(self.history_file) as f:
+            data = json.load(f)
+        for username, history in data.items():
+            for timestamp, image, num_gpus in history:
+                self.record(username, image, num_gpus, timestamp)
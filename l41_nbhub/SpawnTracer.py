@@ -0,0 +1,110 @@
+from contextlib import contextmanager
+import json
+import os
+import random
+import time
+import uuid
+import zlib
+
+
+class SpawnTracer:
+    """
+    Structured, sampled event logging for the spawner. Every event is a single JSON line with the event name,
+    the user, the spawn ID and a few key fields. Events of a spawn are kept or dropped together, decided from
+    the spawn ID, and a token bucket caps the number of lines per second across the hub.
+    Users listed in debug_users (or in debug_file, re-read when it changes) are always traced, with details.
+    """
+    def __init__(self, log, sample_rate=1.0, rate_limit=20, debug_users=None, debug_file=None):
+        """
+        Args:
+            log: logging.Logger to write the events to
+            sample_rate: Fraction of spawns (and of events outside a spawn) that are logged
+            rate_limit: Maximum number of events per second, 0 for no limit
+            debug_users: Usernames whose events are always logged, including the debug details
+            debug_file: File with one username per line to put in debug mode without restarting the hub
+        """
+        self.log = log
+        self.sample_rate = sample_rate
+        self.rate_limit = rate_limit
+        self.debug_users = set(debug_users or [])
+        self.debug_file = debug_file
+        self.debug_file_mtime = None
+        self.debug_file_users = set()
+        self.debug_file_checked = 0
+        self.tokens = rate_limit
+        self.last_refill = time.time()
+        self.dropped = 0
+
+    @staticmethod
+    def new_spawn_id():
+        return uuid.uuid4().hex[:12]
+
+    def is_debug(self, username):
+        if self.debug_file and time.time() - self.debug_file_checked > 5:
+            self.debug_file_checked = time.time()
+            try:
+                mtime = os.path.getmtime(self.debug_file)
+            except OSError:
+                mtime = None
+                self.debug_file_users = set()
+            if mtime is not None and mtime != self.debug_file_mtime:
+                with open(self.debug_file) as f:
+                    self.debug_file_users = set(line.strip() for line in f if line.strip())
+            self.debug_file_mtime = mtime
+        return username in self.debug_users or username in self.debug_file_users
+
+    def _sampled(self, spawn_id):
+        if self.sample_rate >= 1:
+            return True
+        if spawn_id:
+            # Same decision for every event of a spawn
+            return zlib.crc32(spawn_id.encode()) % 10000 < self.sample_rate * 10000
+        return random.random() < self.sample_rate
+
+    def _take_token(self):
+        if not self.rate_limit:
+            return True
+        now = time.time()
+        self.tokens = min(self.rate_limit, self.tokens + (now - self.last_refill) * self.rate_limit)
+        self.last_refill = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def event(self, event, username, spawn_id=None, debug=None, **fields):
+        """
+        Log one event if it passes sampling and the rate limit
+        Args:
+            debug: Bulky details (e.g. the Marathon request) that are only logged for users in debug mode
+
+        Returns:
+            Whether the event was logged
+        """
+        in_debug = self.is_debug(username)
+        if not in_debug and not (self._sampled(spawn_id) and self._take_token()):
+            self.dropped += 1
+            return False
+        record = dict(fields, event=event, user=username, ts=round(time.time(), 3))
+        if spawn_id:
+            record['spawn_id'] = spawn_id
+        if in_debug and debug is not None:
+            record['debug'] = debug
+        self.log.info(json.dumps(record, sort_keys=True, default=str))
+        return True
+
+    @contextmanager
+    def phase(self, phase, username, spawn_id=None, **fields):
+        """
+        Time a block and log it as a phase event with duration_ms, also when the block fails
+        """
+        start = time.time()
+        status = 'ok'
+        try:
+            yield fields
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            self.event('phase', username, spawn_id=spawn_id, phase=phase, status=status,
+                       duration_ms=round((time.time() - start) * 1000, 1), **fields)
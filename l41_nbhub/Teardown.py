@@ -0,0 +1,45 @@
+import requests
+
+
+def bulk_teardown(marathon, group, container_names, gpu_resources, max_workers=16, group_delete=False, keep=(),
+                  check_remaining=False):
+    """
+    Delete many notebook apps at once and release their GPUs with a single write
+    Args:
+        marathon: Marathon client
+        group: Marathon group name of the notebooks
+        container_names: A dictionary of the format {username:container_name}
+        gpu_resources: GPUResourceAllocator holding the users' GPUs
+        max_workers: Number of deletes sent in parallel
+        group_delete: Delete the whole group with one forced request instead of app by app
+        keep: usernames whose GPUs are left allocated, released by the caller
+        check_remaining: List the group afterwards to find the deleted apps Marathon still lists, one full
+            listing, so only worth it for a whole teardown (e.g. hub shutdown)
+
+    Returns:
+        failed: A dictionary of the format {container_name:error} of the apps that could not be deleted
+        remaining: A list of the deleted apps Marathon still lists (removal still in progress), empty unless
+            check_remaining is set
+    """
+    names = list(container_names.values())
+    if group_delete:
+        try:
+            marathon.delete_group(group)
+            failed = {}
+        except (requests.RequestException, ValueError) as e:
+            failed = dict((name, str(e)) for name in names)
+    else:
+        failed = marathon.stop_containers(names, max_workers=max_workers)
+
+    gpu_resources.release_resources([username for username, name in container_names.items()
+                                     if name not in failed and username not in keep])
+
+    marathon.invalidate_snapshot(group)
+    if not check_remaining:
+        return failed, []
+    try:
+        apps = marathon.get_app_snapshot(group, max_age=0)
+    except (requests.RequestException, ValueError):
+        apps = {}
+    remaining = sorted(name for name in names if name in apps and name not in failed)
+    return failed, remaining
@@ -0,0 +1,163 @@
+import json
+import math
+import os
+
+import requests
+
+from .GPUTelemetry import SampleRing
+
+
+class MesosStatisticsSource:
+    """
+    Reads per-task resource statistics from Mesos agents' /monitor/statistics endpoints
+    (or local JSON files with the same content):
+    [
+        {"executor_id": "notebooks_alice-notebook.4d2f...", "statistics": {"timestamp": 1476900000.0,
+         "cpus_user_time_secs": 12.1, "cpus_system_time_secs": 1.3, "mem_rss_bytes": 524288000}}
+    ]
+    """
+    def __init__(self, locations, timeout=5):
+        self.locations = locations
+        self.timeout = timeout
+
+    def _load(self, location):
+        if os.path.exists(location):
+            with open(location) as f:
+                return json.load(f)
+        response = requests.get(location, timeout=self.timeout, verify=False)
+        response.raise_for_status()
+        return response.json()
+
+    def read_samples(self):
+        """
+        Returns:
+            samples: A list of tuples of (task_id, timestamp, cpu seconds used so far, memory in MB)
+        """
+        samples = []
+        for location in self.locations:
+            try:
+                executors = self._load(location)
+            except (requests.RequestException, ValueError, OSError):
+                # One unreachable agent should not hide the others
+                continue
+            for executor in executors:
+                stats = executor.get('statistics', {})
+                try:
+                    cpu_time = stats.get('cpus_user_time_secs', 0) + stats.get('cpus_system_time_secs', 0)
+                    samples.append((executor['executor_id'], float(stats['timestamp']), float(cpu_time),
+                                    stats.get('mem_rss_bytes', 0) / 2 ** 20))
+                except (KeyError, TypeError, ValueError):
+                    continue
+        return samples
+
+
+class UsageRecorder:
+    """
+    Keeps compact CPU and memory histories per user and per image, and suggests resource profiles from them.
+    Memory is sized from the highest usage seen (a notebook above its reservation is OOM killed),
+    CPU from the 95th percentile (CPU shares are only a soft limit).
+    """
+    def __init__(self, source, history_size=512, headroom=0.25, min_samples=30, min_mem=512, max_mem=4096,
+                 min_cpus=0.25, max_cpus=1.0, history_file=None):
+        """
+        Args:
+            source: Object with a read_samples() method, e.g. MesosStatisticsSource
+            history_size: Number of samples kept per user and per image
+            headroom: Fraction added on top of the observed usage
+            min_samples: Samples needed before a profile is suggested
+            min_mem, max_mem: Bounds of the suggested memory, in MB
+            min_cpus, max_cpus: Bounds of the suggested CPUs
+            history_file: JSON file the histories are saved to and restored from
+        """
+        self.source = source
+        self.history_size = history_size
+        self.headroom = headroom
+        self.min_samples = min_samples
+        self.min_mem = min_mem
+        self.max_mem = max_mem
+        self.min_cpus = min_cpus
+        self.max_cpus = max_cpus
+        self.history_file = history_file
+        # key -> (cpu ring, memory ring), keys are 'user:<name>' and 'image:<name>'
+        self.histories = {}
+        # task_id -> (timestamp, cpu seconds) of the previous sample
+        self.last_cpu = {}
+        if history_file and os.path.exists(history_file):
+            self.load()
+
+    def _rings(self, key):
+        if key not in self.histories:
+            self.histories[key] = (SampleRing(self.history_size), SampleRing(self.history_size))
+        return self.histories[key]
+
+    def collect(self, task_owner):
+        """
+        Record new samples
+        Args:
+            task_owner: Function mapping a task ID to (username, image), or None for tasks that are not notebooks
+
+        Returns:
+            Number of samples recorded
+        """
+        recorded = 0
+        seen = set()
+        for task_id, timestamp, cpu_time, mem in self.source.read_samples():
+            seen.add(task_id)
+            previous = self.last_cpu.get(task_id)
+            self.last_cpu[task_id] = (timestamp, cpu_time)
+            owner = task_owner(task_id)
+            if owner is None or previous is None or timestamp <= previous[0]:
+                continue
+            cpus = max(0.0, (cpu_time - previous[1]) / (timestamp - previous[0]))
+            username, image = owner
+            for key in ('user:%s' % username, 'image:%s' % image):
+                cpu_ring, mem_ring = self._rings(key)
+                cpu_ring.append(timestamp, cpus)
+                mem_ring.append(timestamp, mem)
+            recorded += 1
+        for task_id in list(self.last_cpu):
+            if task_id not in seen:
+                del self.last_cpu[task_id]
+        return recorded
+
+    @staticmethod
+    def _percentile(values, fraction):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(math.ceil(fraction * len(values))) - 1)]
+
+    def suggest(self, username, image):
+        """
+        Suggest a resource profile from the user's history, or from the image's when the user has too few samples
+        Returns:
+            (mem_limit, cpus): Memory in MB and number of CPUs, or None without enough history
+        """
+        for key in ('user:%s' % username, 'image:%s' % image):
+            if key in self.histories and self.histories[key][0].count >= self.min_samples:
+                cpu_ring, mem_ring = self.histories[key]
+                break
+        else:
+            return None
+        mem = max(mem_ring.recent_values()) * (1 + self.headroom)
+        mem = int(math.ceil(mem / 256.0) * 256)
+        cpus = self._percentile(cpu_ring.recent_values(), 0.95) * (1 + self.headroom)
+        cpus = math.ceil(cpus * 4) / 4.0
+        return (min(self.max_mem, max(self.min_mem, mem)),
+                min(self.max_cpus, max(self.min_cpus, cpus)))
+
+    def save(self):
+        data = {}
+        for key, (cpu_ring, mem_ring) in self.histories.items():
+            data[key] = [[round(value, 3) for value in cpu_ring.recent_values()],
+                         [round(value, 1) for value in mem_ring.recent_values()]]
+        with open(self.history_file, 'w') as fOut:
+            json.dump(data, fOut)
+
+    def load(self):
+        with open(self.history_file) as f:
+            data = json.load(f)
+        for key, (cpu_values, mem_values) in data.items():
+            cpu_ring, mem_ring = self._rings(key)
+            # Order within a history does not matter for the profile, timestamps are not kept
+            for cpus, mem in zip(cpu_values, mem_values):
+                cpu_ring.append(0, cpus)
+                mem_ring.append(0, mem)
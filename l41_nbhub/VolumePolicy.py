@@ -0,0 +1,151 @@
+from collections import OrderedDict
+import posixpath
+
+# Marker key of trie nodes where an allowed prefix ends, holds the most permissive mode for that prefix
+_END = None
+
+
+class VolumePolicy:
+    """
+    Admin-defined host paths that users may mount. Allowed prefixes are compiled into a trie of path
+    components, so checking a mount costs one dictionary lookup per component of its host path.
+    Prefixes may use {USERNAME} and {USERID}, they are expanded per user and the compiled tries of the
+    most recent users are cached.
+    """
+    def __init__(self, allowed_prefixes, cache_size=1024):
+        """
+        Args:
+            allowed_prefixes: A list of host path prefixes, either a string (mounted read-write) or a
+                pair of (prefix, mode) with mode "RW" or "RO"
+            cache_size: Number of compiled tries kept, least recently used first out
+        """
+        self.allowed_prefixes = []
+        for entry in allowed_prefixes:
+            if isinstance(entry, str):
+                prefix, mode = entry, 'RW'
+            else:
+                prefix, mode = entry
+            if mode not in ('RW', 'RO'):
+                raise ValueError("Invalid volume mode %s for %s." % (mode, prefix))
+            self.allowed_prefixes.append((prefix, mode))
+        self.templated = any('{' in prefix for prefix, mode in self.allowed_prefixes)
+        self.cache_size = cache_size
+        self.compiled = OrderedDict()
+
+    @staticmethod
+    def _components(path):
+        return [part for part in path.split('/') if part]
+
+    def _compile(self, prefixes):
+        trie = {}
+        for prefix, mode in prefixes:
+            node = trie
+            for part in self._components(self.normalize(prefix)):
+                node = node.setdefault(part, {})
+            if node.get(_END) != 'RW':
+                node[_END] = mode
+        return trie
+
+    def trie_for(self, expand):
+        """
+        The compiled trie with the prefixes expanded by `expand`, only calling it when a prefix is templated
+        """
+        if self.templated:
+            prefixes = tuple((expand(prefix) if '{' in prefix else prefix, mode)
+                             for prefix, mode in self.allowed_prefixes)
+        else:
+            prefixes = tuple(self.allowed_prefixes)
+        trie = self.compiled.pop(prefixes, None)
+        if trie is None:
+            trie = self._compile(prefixes)
+            if len(self.compiled) >= self.cache_size:
+                self.compiled.popitem(last=False)
+        # Most recently used last
+        self.compiled[prefixes] = trie
+        return trie
+
+    @staticmethod
+    def normalize(path):
+        if not isinstance(path, str) or not path.startswith('/'):
+            raise ValueError("Volume paths must be absolute: %r" % (path,))
+        # Resolves '..' so a path cannot climb out of an allowed prefix
+        return posixpath.normpath(path).replace('//', '/')
+
+    @staticmethod
+    def lookup(trie, path):
+        """
+        Most specific allowed mode for a normalized host path, None if it is not under an allowed prefix
+        """
+        node = trie
+        mode = node.get(_END)
+        for part in path.split('/'):
+            if not part:
+                continue
+            node = node.get(part)
+            if node is None:
+                break
+            mode = node.get(_END, mode)
+        return mode
+
+    def validate(self, volumes, expand=lambda path: path):
+        """
+        Validate, normalize and deduplicate requested mounts
+        Args:
+            volumes: A list of entries as accepted by MarathonSpawner.volumes: a path (same on host and
+                container), or a tuple of (hostPath, containerPath) or (hostPath, containerPath, mode)
+            expand: Function expanding {USERNAME}/{USERID} in templated prefixes
+
+        Returns:
+            volumes: A list of tuples of (hostPath, containerPath, mode), one per container path
+        """
+        trie = self.trie_for(expand)
+        validated = []
+        seen = {}
+        for item in volumes:
+            if isinstance(item, str):
+                host_path, container_path, mode = item, item, 'RW'
+            elif isinstance(item, (tuple, list)) and len(item) in (2, 3):
+                host_path, container_path = item[0], item[1]
+                mode = item[2] if len(item) == 3 else 'RW'
+                if not isinstance(mode, str):
+                    raise ValueError("Invalid volume mode %r for %s." % (mode, host_path))
+                mode = mode.upper()
+            else:
+                raise ValueError("Invalid volume: %r" % (item,))
+            host_path = self.normalize(host_path)
+            container_path = self.normalize(container_path)
+
+            allowed = self.lookup(trie, host_path)
+            if allowed is None:
+                raise ValueError("Mounting %s is not allowed." % host_path)
+            if mode not in ('RW', 'RO'):
+                raise ValueError("Invalid volume mode %s for %s." % (mode, host_path))
+            if allowed == 'RO':
+                mode = 'RO'
+
+            volume = (host_path, container_path, mode)
+            if container_path in seen:
+                if seen[container_path] != volume:
+                    raise ValueError("Conflicting mounts for %s." % container_path)
+                continue
+            seen[container_path] = volume
+            validated.append(volume)
+        return validated
+
+
+def merge_volumes(volumes, runtime_volumes):
+    """
+    Append runtime volumes to the configured ones, skipping those whose container path is already mounted
+    """
+    def container_path(item):
+        if isinstance(item, str):
+            return posixpath.normpath(item)
+        return posixpath.normpath(item[1])
+
+    taken = set(container_path(item) for item in volumes)
+    merged = list(volumes)
+    for item in runtime_volumes:
+        if container_path(item) not in taken:
+            taken.add(container_path(item))
+            merged.append(item)
+    return merged
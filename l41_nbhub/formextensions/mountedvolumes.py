@@ -1,9 +1,10 @@
+import ast
 import requests
 import json
 import os
 
 class MountedVolumesExtension(object):
-    def __init__(self, volume_mapping):
+    def __init__(self, volume_mapping, volume_policy=None):
         """
         A list in Marathon REST API format for mounting volumes into the Docker container.
         [
@@ -15,6 +16,8 @@ class MountedVolumesExtension(object):
         ]
         """
         self.volume_mapping = volume_mapping
+        # l41_nbhub.VolumePolicy checking the mounts requested in the form, none are accepted without one
+        self.volume_policy = volume_policy
     
     def options_form(self, context):
         html = """
@@ -25,7 +28,19 @@ class MountedVolumesExtension(object):
 
     def options_from_form(self, options, formdata, context):
         options['mounted_volumes'] = ''.join(formdata['mounted_volumes'])
-        self.volume_mapping = ast.literal_eval(options['mounted_volumes'])
+        if not options['mounted_volumes']:
+            return options
+        if self.volume_policy is None:
+            raise ValueError("Mounting volumes is not allowed.")
+        requested = ast.literal_eval(options['mounted_volumes'])
+        if not isinstance(requested, (list, tuple)):
+            requested = [requested]
+        requested = [(item['hostPath'], item['containerPath'], item.get('mode', 'RW')) if isinstance(item, dict) else item
+                     for item in requested]
+        self.volume_mapping = [
+            {"containerPath": container_path, "hostPath": host_path, "mode": mode}
+            for host_path, container_path, mode in self.volume_policy.validate(requested, context._expand_user_vars)
+        ]
         return options
 
     def modify_request(self, docker_container, app_container, app_request, context):
@@ -1,3 +1,6 @@
+from tornado import gen
+
+
 class NvidiaGpuExtension(object):
     def __init__(self, gpu_manager):
         self.gpu_manager = gpu_manager
@@ -16,20 +19,29 @@ class NvidiaGpuExtension(object):
 
     def options_from_form(self, options, formdata, context):
         options['num_gpus'] = ''.join(formdata['num_gpus'])
-        hostname, gpu_ids = self.gpu_manager.get_host_id(context.user.name, int(options['num_gpus']))
-        driver_version = self.gpu_manager.get_driver_version(hostname)
+        context.num_gpus = int(options['num_gpus'] or 0)
+        return options
+
+    @gen.coroutine
+    def prepare(self, context):
+        """
+        Allocate the GPUs and look up the host's driver, off the IOLoop
+        """
+        if not context.num_gpus:
+            return
+        hostname, gpu_ids = yield context.run_blocking(self.gpu_manager.get_host_id, context.user.name,
+                                                       context.num_gpus, context.gpu_shared)
         self.hostname = hostname
         self.gpu_ids = gpu_ids
-        self.driver_version = driver_version
-        return options
+        self.driver_version = self.gpu_manager.get_driver_version(hostname)
 
     def modify_request(self, docker_container, app_container, app_request, context):
-        if not self.hostname or self.gpu_ids or self.driver_version:
+        if not self.hostname or not self.gpu_ids:
             return
 
-        constraint = [[
+        constraints = [
             ["hostname", "LIKE", self.hostname]
-        ]]
+        ]
         parameters = [
             {"key": "device", "value": "/dev/nvidiactl"},
             {"key": "device", "value": "/dev/nvidia-uvm"},
@@ -15,7 +15,8 @@ class SelectImageExtension(object):
         else:
             r = requests.get(self.path_to_image_list)
             image_list = r.text.split("\n")
-        return image_list
+        # One "display name,image" per line
+        return [line.strip().split(",") for line in image_list if line.strip()]
 
     def options_form(self, context):
         html = "<select name=\"image\">"
@@ -26,7 +27,8 @@ class SelectImageExtension(object):
         
     def options_from_form(self, options, formdata, context):
         options['image'] = ''.join(formdata['image'])
-        assert options['image'] in self.get_image_list()
+        if options['image'] not in [image_name for display_name, image_name in self.get_image_list()]:
+            raise ValueError("Invalid image specified.")
         self.image = options['image']
         return options
 
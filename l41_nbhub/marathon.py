@@ -1,8 +1,14 @@
+import codecs
+import json
 import os
-import pprint
 import requests
 import socket
+import threading
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
 from copy import deepcopy
+from urllib.parse import urlparse
 
 
 container_type = 'docker'
@@ -22,20 +28,436 @@ default_request = {
   "constraints": []
 }
 
+# Read timeouts in seconds per operation
+default_timeouts = {
+    'get': 5,
+    'post': 30,
+    'put': 30,
+    'delete': 30
+}
+
+idempotent_requests = ('get', 'put', 'delete')
+retry_status_codes = (502, 503, 504)
+
+
+class MarathonUnavailable(ValueError):
+    """
+    Raised without contacting Marathon while the circuit breaker is open
+    """
+
+
+class AppRecord:
+    """
+    The few fields of a Marathon app the hub looks at, taken from its first task
+    """
+    __slots__ = ('id', 'state', 'host', 'port', 'version', 'image', 'tasks', 'deployments')
+
+    def __init__(self, id, state=None, host=None, port=None, version=None, image=None, tasks=0, deployments=0):
+        self.id = id
+        self.state = state
+        self.host = host
+        self.port = port
+        self.version = version
+        self.image = image
+        self.tasks = tasks
+        self.deployments = deployments
+
+    @classmethod
+    def from_app(cls, app):
+        tasks = app.get('tasks', [])
+        record = cls(app['id'], version=app.get('version'), tasks=len(tasks),
+                     deployments=len(app.get('deployments') or []),
+                     image=(app.get('container') or {}).get(container_type, {}).get('image'))
+        if tasks:
+            # Tasks listed without a state predate task states in the API and are running
+            record.state = tasks[0].get('state', 'TASK_RUNNING')
+            record.host = tasks[0].get('host')
+            ports = tasks[0].get('ports') or [None]
+            record.port = ports[0]
+        return record
+
+
+class RequestView:
+    """
+    Attribute access to a dictionary of an app request, as the formextensions' modify_request hooks expect
+    (e.g. docker_container.parameters.extend(...)). Nested dictionaries are wrapped too, writes go to the dictionary.
+    """
+    __slots__ = ('_data',)
+
+    def __init__(self, data):
+        object.__setattr__(self, '_data', data)
+
+    def __getattr__(self, name):
+        try:
+            value = self._data[name]
+        except KeyError:
+            raise AttributeError(name)
+        return RequestView(value) if isinstance(value, dict) else value
+
+    def __setattr__(self, name, value):
+        self._data[name] = value
+
+
+def iter_apps(chunks, key='apps'):
+    """
+    Decode the apps of a listing ({"apps": [...]}) one at a time from chunks of the response body, so only one
+    app's JSON is held at once instead of the whole listing
+    Args:
+        chunks: Iterable of bytes, e.g. response.iter_content()
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buf = ''
+    eof = False
+
+    def more(size=1):
+        """
+        Decode chunks until at least size characters were read or the body ended
+        """
+        parts = []
+        read = 0
+        while read < size:
+            chunk = next(chunks, None)
+            if chunk is None:
+                parts.append(text.decode(b'', final=True))
+                return ''.join(parts), True
+            parts.append(text.decode(chunk))
+            read += len(parts[-1])
+        return ''.join(parts), False
+
+    # Skip to the start of the array
+    start = '"%s"' % key
+    while True:
+        index = buf.find(start)
+        if index >= 0:
+            bracket = buf.find('[', index + len(start))
+            if bracket >= 0:
+                buf = buf[bracket + 1:]
+                break
+        if eof:
+            return
+        chunk, eof = more()
+        buf += chunk
+
+    # Decoded in place, the buffer is only cut when more of the body is read
+    pos = 0
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        if pos == len(buf):
+            if eof:
+                return
+            chunk, eof = more()
+            buf, pos = chunk, 0
+            continue
+        if buf[pos] == ']':
+            return
+        try:
+            app, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            if eof:
+                raise
+            # The app continues in the next chunks, read as much again so large apps stay linear
+            buf = buf[pos:]
+            chunk, eof = more(len(buf))
+            buf, pos = buf + chunk, 0
+            continue
+        pos = end
+        yield app
+
+
 class Marathon:
-    def __init__(self, hostname):
-        self.hostname = hostname
+    # Shared by all clients, hedged reads only need a couple of threads each
+    _executor = ThreadPoolExecutor(max_workers=8)
+
+    def __init__(self, hostname, health_check_interval=10, failover_cooldown=30, timeouts=None, connect_timeout=3,
+                 max_retries=3, backoff_base=0.1, backoff_max=2, retry_budget=10, breaker_threshold=5,
+                 breaker_reset=30, hedge_delay=None):
+        """
+        Client for one or more Marathon masters
+        Args:
+            hostname: URL of a Marathon master, a comma separated string or a list of URLs
+            health_check_interval: Seconds between runs of check_health, which the owner of the client schedules
+                in the background
+            failover_cooldown: Seconds a master that failed a request is skipped for
+            timeouts: Read timeouts per operation, overrides entries of default_timeouts
+            connect_timeout: Seconds to wait for a connection to a master
+            max_retries: Retries of idempotent requests that failed or got a 502/503/504
+            backoff_base, backoff_max: Exponential backoff between retries, in seconds
+            retry_budget: Seconds after the first attempt in which retries may still start
+            breaker_threshold: Consecutive failures after which requests fail fast
+            breaker_reset: Seconds the breaker stays open before a single trial request is let through
+            hedge_delay: Seconds after which a second copy of a status read is sent, None disables hedging
+
+        """
+        if isinstance(hostname, str):
+            hostname = hostname.split(',')
+        self.hosts = [host.strip() for host in hostname if host.strip()]
+        if not self.hosts:
+            raise ValueError("No Marathon endpoint configured.")
+        self.hostname = self.hosts[0]
+        self.health_check_interval = health_check_interval
+        self.failover_cooldown = failover_cooldown
+        self.leader = None
+        self.down_until = {}
+        self.last_health_check = 0
+        self.next_read = 0
+        self.timeouts = dict(default_timeouts, **(timeouts or {}))
+        self.connect_timeout = connect_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_budget = retry_budget
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.hedge_delay = hedge_delay
+        self.consecutive_failures = 0
+        self.breaker_open_until = 0
+        # Set while the one trial request of a half-open breaker is in flight
+        self.breaker_trial = False
+        # requests, retries, timeouts, failures, breaker_trips, breaker_rejections, hedged, hedge_wins
+        self.stats = Counter()
+        self.snapshots = {}
+        # group -> (started, Future) of the listing in flight, which concurrent callers wait for
+        self.snapshot_fetches = {}
+        # One client is shared by the IOLoop and executor threads, guards the health, breaker, stats and
+        # snapshot state above. Never held during a request.
+        self.lock = threading.Lock()
+
+    def _count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def _is_healthy(self, host, now=None):
+        return self.down_until.get(host, 0) <= (now or time.time())
+
+    def _mark_down(self, host):
+        with self.lock:
+            self.down_until[host] = time.time() + self.failover_cooldown
+            if host == self.leader:
+                self.leader = None
+
+    def _leader_url(self, leader, reference):
+        """
+        Map the host:port reported by /v2/leader onto one of the configured URLs
+        """
+        for host in self.hosts:
+            if urlparse(host).netloc == leader:
+                return host
+        return '%s://%s' % (urlparse(reference).scheme or 'http', leader)
+
+    def check_health(self):
+        """
+        Ping every master and ask the first healthy one for the current leader. Blocking, run periodically
+        off the request path; requests only read the results.
+        """
+        started = time.time()
+        leader = None
+        up, down = [], []
+        for host in self.hosts:
+            try:
+                requests.get(os.path.join(host, 'ping'), timeout=2).raise_for_status()
+                up.append(host)
+            except requests.RequestException:
+                down.append(host)
+                continue
+            if leader is None:
+                try:
+                    reported = requests.get(os.path.join(host, 'v2/leader'), timeout=2).json()['leader']
+                    leader = self._leader_url(reported, host)
+                except (requests.RequestException, ValueError, KeyError):
+                    pass
+        # Applied at once, requests never see a half finished check
+        with self.lock:
+            self.last_health_check = started
+            self.leader = leader
+            for host in up:
+                self.down_until.pop(host, None)
+            for host in down:
+                self.down_until[host] = time.time() + self.failover_cooldown
 
-    def _make_request(self, type, endpoint, data=None, json_data=None):
-        url = os.path.join(self.hostname, endpoint)
-        if type.lower() == 'get':
-            return requests.get(url)
-        elif type.lower() == 'post':
-            r = requests.post(url, json=json_data)
-            return r
-        elif type.lower() == 'delete':
-            return requests.delete(url)
+    def _candidate_hosts(self, type):
+        """
+        Order in which masters are tried: writes go to the leader first, reads rotate over the healthy masters.
+        Masters marked down are only tried as a last resort. Until a health check found the leader, writes go to
+        any master, which forwards them to the leader.
+        """
+        if len(self.hosts) == 1:
+            return self.hosts
+        now = time.time()
+        with self.lock:
+            healthy = [host for host in self.hosts if self._is_healthy(host, now)]
+            down = [host for host in self.hosts if host not in healthy]
+            leader = self.leader
+            if type == 'get' and healthy:
+                self.next_read = (self.next_read + 1) % len(healthy)
+                start = self.next_read
+        if type == 'get' and healthy:
+            healthy = healthy[start:] + healthy[:start]
+        elif leader:
+            healthy = [leader] + [host for host in healthy if host != leader]
+        return healthy + down
 
+    def _check_breaker(self):
+        """
+        Fail fast while the breaker is open. Once it has been open for breaker_reset seconds, a single trial
+        request is let through; its result closes or reopens the breaker.
+        Returns:
+            Whether this request is the trial
+        """
+        now = time.time()
+        with self.lock:
+            if self.consecutive_failures < self.breaker_threshold:
+                return False
+            if now < self.breaker_open_until or self.breaker_trial:
+                self.stats['breaker_rejections'] += 1
+                raise MarathonUnavailable("Marathon is unavailable, retrying in %i seconds." %
+                                          max(0, self.breaker_open_until - now))
+            self.breaker_trial = True
+            return True
+
+    def _record_failure(self, trial=False):
+        """
+        Args:
+            trial: The request was the trial of a half-open breaker
+
+        Returns:
+            Whether the breaker is open, no more attempts should be made
+        """
+        with self.lock:
+            self.stats['failures'] += 1
+            self.consecutive_failures += 1
+            if self.consecutive_failures < self.breaker_threshold:
+                return False
+            if self.consecutive_failures == self.breaker_threshold or trial:
+                # Tripped, or reopened by a failed trial request for another period
+                self.stats['breaker_trips'] += 1
+            self.breaker_open_until = time.time() + self.breaker_reset
+            return True
+
+    def _record_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+
+    def _send(self, type, endpoint, json_data=None, hosts=None, stream=False):
+        """
+        Send a single request, failing over to the next master when one cannot be reached
+        Args:
+            stream: Leave the body of a GET to be read incrementally
+        """
+        timeout = (self.connect_timeout, self.timeouts[type])
+        error = None
+        for host in hosts or self._candidate_hosts(type):
+            url = os.path.join(host, endpoint)
+            try:
+                if type == 'get':
+                    return requests.get(url, timeout=timeout, stream=stream)
+                elif type == 'post':
+                    r = requests.post(url, json=json_data, timeout=timeout)
+                    return r
+                elif type == 'put':
+                    return requests.put(url, json=json_data, timeout=timeout)
+                elif type == 'delete':
+                    return requests.delete(url, timeout=timeout)
+            except requests.ConnectionError as e:
+                # Includes connect timeouts, nothing reached Marathon so any master can take the request
+                self._mark_down(host)
+                error = e
+            except requests.Timeout as e:
+                self._count('timeouts')
+                self._mark_down(host)
+                if type not in idempotent_requests:
+                    # Marathon may already be processing it
+                    raise
+                error = e
+        raise error
+
+    def _hedged_get(self, endpoint):
+        """
+        Send a read to one master and, if it has not answered after hedge_delay, the same read to another one.
+        The first answer wins.
+        """
+        hosts = self._candidate_hosts('get')
+        first = self._executor.submit(self._send, 'get', endpoint, hosts=hosts)
+        done, pending = wait([first], timeout=self.hedge_delay)
+        if done:
+            return first.result()
+
+        self._count('hedged')
+        hedge_hosts = hosts[1:] + hosts[:1]
+        second = self._executor.submit(self._send, 'get', endpoint, hosts=hedge_hosts)
+        futures = [first, second]
+        while futures:
+            done, pending = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                futures.remove(future)
+                if future.exception() is None:
+                    if future is second:
+                        self._count('hedge_wins')
+                    return future.result()
+        return first.result()
+
+    def _make_request(self, type, endpoint, data=None, json_data=None, hedge=False, stream=False):
+        """
+        Send a request with per-operation timeouts. Idempotent requests are retried with exponential backoff
+        on connection errors, timeouts and 502/503/504 answers, as long as retry_budget allows. Once too many
+        consecutive requests failed, the circuit breaker makes further requests fail fast with MarathonUnavailable.
+        Blocks while backing off, callers on the IOLoop run it in an executor.
+        Args:
+            hedge: Send a second copy of a GET when the first one is slow (only if hedge_delay is set)
+            stream: Leave the body of a GET to be read incrementally
+
+        Returns:
+            The last response, whatever its status code, if any master answered
+        """
+        type = type.lower()
+        trial = self._check_breaker()
+        try:
+            return self._attempt(type, endpoint, json_data, hedge, stream, trial)
+        finally:
+            if trial:
+                # Whatever its outcome, the breaker is closed or reopened by now
+                with self.lock:
+                    self.breaker_trial = False
+
+    def _attempt(self, type, endpoint, json_data, hedge, stream, trial):
+        started = time.time()
+        attempts = 1 + (self.max_retries if type in idempotent_requests else 0)
+        response = error = None
+        for attempt in range(attempts):
+            if attempt:
+                delay = min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1))
+                if time.time() + delay - started > self.retry_budget:
+                    break
+                self._count('retries')
+                time.sleep(delay)
+            self._count('requests')
+            try:
+                if hedge and type == 'get' and self.hedge_delay is not None:
+                    response = self._hedged_get(endpoint)
+                else:
+                    response = self._send(type, endpoint, json_data=json_data, stream=stream)
+            except requests.RequestException as e:
+                error = e
+                if self._record_failure(trial) or type not in idempotent_requests:
+                    break
+                continue
+
+            if response.status_code in retry_status_codes:
+                if stream:
+                    # Read the short error page (returned if the retries fail too) and give the connection back
+                    response.content
+                    response.close()
+                if self._record_failure(trial):
+                    break
+                continue
+            self._record_success()
+            return response
+
+        if response is not None:
+            return response
+        raise error
 
     def start_container(self,
                         container_name,
@@ -46,9 +468,17 @@ class Marathon:
                         parameters= [{}],
                         resources=None,
                         mem_limit=128,
+                        cpus=1,
                         volumes=[],
                         ports=[],
-                        network_mode='BRIDGE'):
+                        network_mode='BRIDGE',
+                        health_checks=None,
+                        modify_request=None):
+        """
+        Args:
+            modify_request: Function called with RequestViews of (docker container, container, app request)
+                before the request is sent, e.g. to apply formextensions' modify_request hooks
+        """
         new_request = deepcopy(default_request)
         if container_name.startswith('/'):
             new_request['id'] = container_name
@@ -58,24 +488,31 @@ class Marathon:
         if len(entry_point.strip()) > 0:
             new_request['cmd'] = entry_point
         new_request['mem'] = mem_limit
+        new_request['cpus'] = cpus
         new_request['env'] = {}
-        new_request['constraints'] = constraints
+        # Copies, hooks extend them and the caller's lists may be configuration
+        new_request['constraints'] = list(constraints)
+        if health_checks:
+            new_request['healthChecks'] = health_checks
         for key in env:
             new_request['env'][key] = env[key]
 
         new_container = deepcopy(default_container)
         if container_type == 'docker':
             new_container['docker']['image'] = image_name
-            new_container['docker']['parameters'] = parameters
+            new_container['docker']['parameters'] = list(parameters)
         else:
             new_container['mesos']['image']['type'] = 'DOCKER'
             new_container['mesos']['image']['docker'] = {'name':image_name}
 
         # Map Volumes
         for item in volumes:
-            if isinstance(item, tuple):
+            mode = 'RW'
+            if isinstance(item, (tuple, list)):
                 hostPath = item[0]
                 containerPath = item[1]
+                if len(item) > 2:
+                    mode = item[2]
             else:
                 hostPath = item
                 containerPath = item
@@ -83,7 +520,7 @@ class Marathon:
             volume = {
                 'containerPath': containerPath,
                 'hostPath': hostPath,
-                'mode': 'RW'
+                'mode': mode
             }
             new_container['volumes'].append(volume)
 
@@ -97,9 +534,23 @@ class Marathon:
 
         new_container['docker']['network'] = network_mode
         new_request['container'] = new_container
-        pprint.pprint(new_request)
+        if modify_request:
+            modify_request(RequestView(new_container[container_type]), RequestView(new_container),
+                           RequestView(new_request))
         response = self._make_request('POST', 'v2/apps', json_data=new_request)
         if response.status_code == 201:
+            # The created app, including the version of this deployment
+            return response.json()
+        else:
+            raise ValueError(response.text)
+
+    def update_constraints(self, container_name, constraints):
+        """
+        Replace the placement constraints of a deployed app, redeploying it if Marathon has not placed it yet
+        """
+        response = self._make_request('PUT', 'v2/apps/%s?force=true&partialUpdate=true' % container_name,
+                                      json_data={'constraints': constraints})
+        if response.status_code in (200, 201):
             return None
         else:
             raise ValueError(response.text)
@@ -111,6 +562,39 @@ class Marathon:
         else:
             raise ValueError(response.text)
 
+    def stop_containers(self, container_names, max_workers=16):
+        """
+        Delete many apps with bounded parallelism. Apps that are already gone count as deleted.
+        Returns:
+            failed: A dictionary of the format {container_name:error}
+        """
+        failed = {}
+        if not container_names:
+            return failed
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(container_names))) as executor:
+            futures = {executor.submit(self._make_request, 'DELETE', 'v2/apps/%s' % name): name
+                       for name in container_names}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    response = future.result()
+                except (requests.RequestException, ValueError) as e:
+                    failed[name] = str(e)
+                    continue
+                if response.status_code not in (200, 404):
+                    failed[name] = response.text
+        return failed
+
+    def delete_group(self, group, force=True):
+        """
+        Delete a whole group of apps with one request, force cancels deployments still running in it
+        """
+        response = self._make_request('DELETE', 'v2/groups/%s%s' % (group, '?force=true' if force else ''))
+        if response.status_code in (200, 202, 404):
+            return None
+        else:
+            raise ValueError(response.text)
+
     def get_container_env_variable(self, container_name, env_variable):
         response = self._make_request('GET', 'v2/apps/%s'%container_name)
         if response.status_code != 200:
@@ -135,13 +619,86 @@ class Marathon:
         return (ip, running_task['ports'][0])
 
     def get_container_status(self, container_name):
-        response = self._make_request('GET', 'v2/apps/%s'%container_name)
+        response = self._make_request('GET', 'v2/apps/%s'%container_name, hedge=True)
         if response.status_code != 200:
             return None
         container = response.json()['app']
         return container
 
-    def get_running_containers(self):
+    def get_app_snapshot(self, group, max_age=10):
+        """
+        All apps of a group, with their tasks, from a single listing that is reused for max_age seconds.
+        Lets many spawners check their containers (e.g. when the hub restarts) with one request: while a listing
+        is in flight, callers that accept its age wait for it instead of sending their own.
+        Args:
+            group: Marathon group name without slashes
+
+        Returns:
+            apps: A dictionary of the format {app_id:AppRecord}
+        """
+        now = time.time()
+        with self.lock:
+            fetched_at, apps = self.snapshots.get(group, (0, None))
+            if apps is not None and now - fetched_at <= max_age:
+                return apps
+            fetch = self.snapshot_fetches.get(group)
+            joined = fetch is not None and now - fetch[0] <= max_age
+            if not joined:
+                fetch = (now, Future())
+                self.snapshot_fetches[group] = fetch
+        if joined:
+            return fetch[1].result()
+
+        try:
+            apps = {app.id: app for app in self.list_apps(group)}
+        except BaseException as e:
+            with self.lock:
+                if self.snapshot_fetches.get(group) is fetch:
+                    del self.snapshot_fetches[group]
+            fetch[1].set_exception(e)
+            raise
+        with self.lock:
+            # Not cached if the snapshot was invalidated or a newer listing started meanwhile
+            if self.snapshot_fetches.get(group) is fetch:
+                del self.snapshot_fetches[group]
+                self.snapshots[group] = (now, apps)
+        fetch[1].set_result(apps)
+        return apps
+
+    def list_apps(self, group=None, embed=('apps.tasks',), chunk_size=64 * 1024):
+        """
+        Compact listing of the apps: the group is filtered by Marathon, only the given embeds are requested,
+        and the response is parsed one app at a time into AppRecords
+        Args:
+            group: Marathon group name without slashes, all apps when None
+
+        Returns:
+            apps: A list of AppRecords
+        """
+        query = ['embed=%s' % item for item in embed]
+        if group:
+            query.insert(0, 'id=/%s/' % group)
+        response = self._make_request('GET', 'v2/apps?%s' % '&'.join(query), stream=True)
+        try:
+            if response.status_code != 200:
+                raise ValueError(response.text)
+            return [AppRecord.from_app(app) for app in iter_apps(response.iter_content(chunk_size))]
+        finally:
+            response.close()
+
+    def invalidate_snapshot(self, group):
+        with self.lock:
+            self.snapshots.pop(group, None)
+            # Callers from now on do not wait for a listing started before the change
+            self.snapshot_fetches.pop(group, None)
+
+    def get_running_containers(self, compact=False):
+        """
+        Args:
+            compact: Return AppRecords parsed incrementally instead of the full app JSON
+        """
+        if compact:
+            return self.list_apps()
         response = self._make_request('GET', 'v2/apps')
         return response.json()['apps']
 
@@ -1,23 +1,120 @@
-import sys
+import argparse
 import json
+import os
+import shlex
+import sys
 '''
-take a file and unwrap the contents to a dictionary.
+take a file of docker container metadata (docker inspect or
+/containers/json output, filebeat metadata) and unwrap every
+record to a dictionary.
 write the key=value terms out.
 
-The program is intended to be caled from a bash
-program to export the key=value pairs as environemnt
-variables
+The file is read in small chunks and one record is decoded at a
+time, so memory stays bounded by the largest single record. Records
+may be newline delimited JSON objects or the elements of top-level
+JSON arrays (one or several, on one line or many).
+
+By default the key=value terms are printed for the bash wrapper to
+export as environment variables. With --env-dir one env file per
+container is written instead, in a single pass over the file.
 
 '''
 
+CHUNK_SIZE = 64 * 1024
+
+decoder = json.JSONDecoder()
+
+
+def iter_records(stream, chunk_size=CHUNK_SIZE):
+    """Yield every JSON object of the stream, flattening top-level arrays."""
+    buf = ''
+    pos = 0
+    eof = False
+    while True:
+        # skip separators between records
+        while pos < len(buf) and buf[pos] in ' \t\r\n,[]':
+            pos += 1
+        if pos == len(buf):
+            if eof:
+                return
+            # records are decoded in place, the buffer is only replaced once it is used up
+            buf = stream.read(chunk_size)
+            pos = 0
+            eof = not buf
+            continue
+        try:
+            record, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            if eof:
+                raise
+            # record continues in the next chunk, read as much again so long records stay linear
+            buf = buf[pos:]
+            pos = 0
+            more = stream.read(max(chunk_size, len(buf)))
+            eof = not more
+            buf += more
+            continue
+        pos = end
+        if isinstance(record, dict):
+            yield record
+
+
+def format_value(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, separators=(',', ':'), sort_keys=True)
+    return str(value)
+
+
+def env_terms(record):
+    for key in sorted(record):
+        yield "_docker_%s" % key.lower(), format_value(record[key])
+
+
+def container_name(record, index):
+    names = record.get('Names') or [record.get('Name', '')]
+    name = (names[0] or '').strip('/').replace('/', '_')
+    if not name:
+        name = (record.get('Id') or 'container%d' % index)[:12]
+    return name
+
+
+def print_exports(records, out=sys.stdout):
+    for record in records:
+        for key, value in env_terms(record):
+            # the wrapper splits on whitespace
+            out.write("%s=%s\n" % (key, value.replace(' ', '')))
+
+
+def write_env_files(records, env_dir):
+    os.makedirs(env_dir, exist_ok=True)
+    count = 0
+    for index, record in enumerate(records):
+        path = os.path.join(env_dir, "%s.env" % container_name(record, index))
+        with open(path, 'w') as f:
+            for key, value in env_terms(record):
+                f.write("export %s=%s\n" % (key, shlex.quote(value)))
+        count += 1
+    return count
+
 
 def main(argv):
-    a = open(argv[0], 'r')
-    b = a.readlines()[0].strip()
-    data = json.loads(b)[0]
+    parser = argparse.ArgumentParser(description="Turn docker container metadata into environment variables")
+    parser.add_argument('filename', help="metadata file, - for stdin")
+    parser.add_argument('--limit', type=int, default=0,
+                        help="only handle the first LIMIT records (0 for all)")
+    parser.add_argument('--env-dir',
+                        help="write one <container>.env file per record into this directory")
+    args = parser.parse_args(argv)
 
-    for d in data.iterkeys():
-        print "_docker_%s=%s" % (d.lower(), (str(data[d]).replace(' ', '')))
+    stream = sys.stdin if args.filename == '-' else open(args.filename, 'r')
+    with stream:
+        records = iter_records(stream)
+        if args.limit:
+            records = (record for index, record in zip(range(args.limit), records))
+        if args.env_dir:
+            write_env_files(records, args.env_dir)
+        else:
+            print_exports(records)
 
 
 if __name__ == "__main__":
@@ -8,7 +8,7 @@ echo "---- Get self ----"
 # make the docker datastructure into environment variables.
 sleep 1
 curl http://localhost:41000/containers/json > /tmp/self
-for i in `(/usr/bin/python /opt/nopleats/readData.py /tmp/self)`; do export $i; done
+for i in `(/usr/bin/env python3 /opt/nopleats/readData.py /tmp/self --limit 1)`; do export $i; done
 
 echo "---- Env ----"
 # echo check the sorted environent
@@ -0,0 +1,68 @@
+import pytest
+
+from l41_nbhub.AdmissionController import AdmissionCancelled, AdmissionController
+
+
+def test_spawns_within_the_limit_are_admitted_at_once():
+    admission = AdmissionController(2)
+    assert admission.acquire('alice').done()
+    assert admission.acquire('bob').done()
+    assert not admission.acquire('carol').done()
+    assert admission.queue_length() == 1
+
+
+def test_no_limit_admits_everybody():
+    admission = AdmissionController(0)
+    assert all(admission.acquire('user%i' % i).done() for i in range(100))
+
+
+def test_queued_spawns_are_admitted_by_priority_then_in_order():
+    admission = AdmissionController(1)
+    admission.acquire('running')
+    new1 = admission.acquire('new1', AdmissionController.NEW)
+    returning = admission.acquire('returning', AdmissionController.RETURNING)
+    new2 = admission.acquire('new2', AdmissionController.NEW)
+    admin = admission.acquire('admin', AdmissionController.ADMIN)
+    assert [admission.position(name) for name in ('admin', 'returning', 'new1', 'new2')] == [1, 2, 3, 4]
+
+    futures = [('running', None), ('admin', admin), ('returning', returning), ('new1', new1), ('new2', new2)]
+    for (releasing, _), (admitted, future) in zip(futures, futures[1:]):
+        assert not future.done()
+        admission.release(releasing)
+        assert future.done()
+        assert admission.inflight == {admitted}
+    assert admission.queue_length() == 0
+
+
+def test_acquiring_again_does_not_queue_twice():
+    admission = AdmissionController(1)
+    admission.acquire('alice')
+    assert admission.acquire('alice').done()
+    waiting = admission.acquire('bob')
+    assert admission.acquire('bob') is waiting
+    assert admission.queue_length() == 1
+
+
+def test_cancelled_spawns_leave_the_queue():
+    admission = AdmissionController(1)
+    admission.acquire('alice')
+    bob = admission.acquire('bob')
+    carol = admission.acquire('carol')
+    admission.cancel('bob')
+    with pytest.raises(AdmissionCancelled):
+        bob.result()
+    assert admission.position('bob') is None
+    assert admission.position('carol') == 1
+
+    admission.release('alice')
+    assert carol.done()
+    assert admission.inflight == {'carol'}
+
+
+def test_cancelling_an_admitted_spawn_frees_its_slot():
+    admission = AdmissionController(1)
+    admission.acquire('alice')
+    bob = admission.acquire('bob')
+    admission.cancel('alice')
+    assert bob.done()
+    assert admission.inflight == {'bob'}
@@ -0,0 +1,144 @@
+import json
+import random
+
+import pytest
+
+from l41_nbhub.GPUResourceAllocator import AssignmentStrategy, FirstFitStrategy, GPUResourceAllocator
+
+
+def random_state(rng, num_hosts=6, gpus_per_host=4, taken=0.4):
+    state = {}
+    for host in range(num_hosts):
+        state['host%02i' % host] = dict((gpu_id, ['someone'] if rng.random() < taken else [])
+                                        for gpu_id in range(gpus_per_host))
+    return state
+
+
+def random_requests(rng, count=10):
+    return [('user%02i' % i, rng.choice([1, 1, 1, 2, 2, 4])) for i in range(count)]
+
+
+def sequential(strategy, state, requests):
+    """
+    Place the requests one at a time with request_resources, in the given order
+    """
+    state = dict((hostname, dict((gpu_id, list(holders)) for gpu_id, holders in info.items()))
+                 for hostname, info in state.items())
+    placements, rejected = {}, []
+    for username, num_gpus in requests:
+        hostname, gpu_ids = strategy.request_resources(state, username, num_gpus)
+        if not hostname:
+            rejected.append(username)
+            continue
+        for gpu_id in gpu_ids:
+            state[hostname][gpu_id].append(username)
+        placements[username] = (hostname, gpu_ids)
+    return placements, rejected
+
+
+def check_valid(state, requests, placements, rejected):
+    assert sorted(list(placements) + rejected) == sorted(username for username, num_gpus in requests)
+    wanted = dict(requests)
+    used = set()
+    for username, (hostname, gpu_ids) in placements.items():
+        assert len(gpu_ids) == wanted[username]
+        for gpu_id in gpu_ids:
+            # Only free GPUs, never given twice
+            assert state[hostname][gpu_id] == []
+            assert (hostname, gpu_id) not in used
+            used.add((hostname, gpu_id))
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_batch_placement_is_valid_and_places_at_least_as_many_as_sequential(seed):
+    rng = random.Random(seed)
+    state = random_state(rng)
+    requests = random_requests(rng)
+    strategy = FirstFitStrategy()
+    placements, rejected = strategy.request_batch_resources(state, requests)
+    check_valid(state, requests, placements, rejected)
+    sequential_placements, sequential_rejected = sequential(strategy, state, requests)
+    assert len(placements) >= len(sequential_placements)
+
+
+def test_batch_placement_keeps_whole_hosts_for_large_requests():
+    state = {'big': dict((gpu_id, []) for gpu_id in range(4)),
+             'small': {0: [], 1: [], 2: ['someone'], 3: ['someone']}}
+    requests = [('alice', 2), ('bob', 4)]
+    # One at a time, alice takes half of the only free host bob fits on
+    assert sequential(FirstFitStrategy(), state, requests)[1] == ['bob']
+    placements, rejected = FirstFitStrategy().request_batch_resources(state, requests)
+    assert rejected == []
+    assert placements == {'alice': ('small', [0, 1]), 'bob': ('big', [0, 1, 2, 3])}
+
+
+def test_batch_placement_of_everything_that_fits_rejects_nobody():
+    state = {'host%i' % i: dict((gpu_id, []) for gpu_id in range(4)) for i in range(3)}
+    requests = [('a', 4), ('b', 2), ('c', 2), ('d', 1), ('e', 1), ('f', 1), ('g', 1)]
+    placements, rejected = FirstFitStrategy().request_batch_resources(state, requests)
+    check_valid(state, requests, placements, rejected)
+    assert rejected == []
+
+
+class LastFitStrategy(AssignmentStrategy):
+    """
+    Fills the hosts from the last one, only implements request_resources
+    """
+    def request_resources(self, state, username, num_gpus):
+        for hostname, info in sorted(state.items(), reverse=True):
+            free = [gpu_id for gpu_id, holders in sorted(info.items()) if not holders]
+            if len(free) >= num_gpus:
+                return hostname, free[:num_gpus]
+        return None, None
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_default_batch_placement_matches_sequential_placement(seed):
+    rng = random.Random(seed)
+    state = random_state(rng)
+    requests = random_requests(rng)
+    largest_first = sorted(requests, key=lambda request: (-request[1], request[0]))
+    placements, rejected = LastFitStrategy().request_batch_resources(state, requests)
+    expected_placements, expected_rejected = sequential(LastFitStrategy(), state, largest_first)
+    assert placements == expected_placements
+    assert sorted(rejected) == sorted(expected_rejected)
+
+
+def test_default_shared_placement_picks_the_least_loaded_gpus():
+    load = {'host1': {0: 3, 1: 1}, 'host2': {0: 2, 1: 2}, 'host3': {0: 4, 1: 0}}
+    assert LastFitStrategy().request_shared_resources(load, 'alice', 2, 4) == ('host1', [0, 1])
+    assert LastFitStrategy().request_shared_resources(load, 'alice', 1, 4) == ('host3', [1])
+    assert LastFitStrategy().request_shared_resources({'host1': {0: 4}}, 'alice', 1, 4) == (None, None)
+
+
+def test_strategies_have_to_implement_request_resources():
+    class Incomplete(AssignmentStrategy):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+@pytest.fixture
+def allocator(tmp_path):
+    resources = tmp_path / 'resources'
+    resources.write_text('host1 4\nhost2 2\n')
+    return GPUResourceAllocator(str(resources), str(tmp_path / 'status.json'))
+
+
+def test_get_host_ids_saves_every_placement_in_one_write(allocator, monkeypatch):
+    allocator.get_host_id('carol', 1)
+    writes = []
+    save = allocator.save_current_allocations
+    monkeypatch.setattr(allocator, 'save_current_allocations', lambda allocations: writes.append(1) or save(allocations))
+
+    placements, rejected = allocator.get_host_ids([('alice', 2), ('bob', 3), ('carol', 1), ('dave', 4)])
+    assert len(writes) == 1
+    assert rejected == ['dave']
+    # Users that already hold GPUs keep them
+    assert placements['carol'] == ('host1', [0])
+    with open(allocator.status_filename) as f:
+        saved = json.load(f)
+    for username in ('alice', 'bob'):
+        hostname, gpu_ids = placements[username]
+        assert [(data[0], data[1]) for data in saved[username]] == [(hostname, gpu_id) for gpu_id in gpu_ids]
@@ -0,0 +1,284 @@
+import json
+import threading
+import time
+
+import pytest
+import requests
+
+from l41_nbhub import marathon
+from l41_nbhub.marathon import Marathon, MarathonUnavailable
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, body=None, host=None):
+        self.status_code = status_code
+        self.body = body if body is not None else {}
+        self.host = host
+        self.text = json.dumps(self.body)
+        self.content = self.text.encode('utf-8')
+        self.closed = False
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(self.status_code)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeRequests:
+    """
+    Stands in for the requests functions the client calls. `handler` is called with (method, url) and returns
+    a FakeResponse or raises.
+    """
+    def __init__(self, monkeypatch, handler):
+        self.handler = handler
+        self.calls = []
+        self.lock = threading.Lock()
+        for method in ('get', 'post', 'put', 'delete'):
+            monkeypatch.setattr(marathon.requests, method, self._method(method))
+
+    def _method(self, method):
+        def send(url, **kwargs):
+            with self.lock:
+                self.calls.append((method, url))
+            return self.handler(method, url)
+        return send
+
+
+def client(hosts='http://a:8080', **kwargs):
+    kwargs.setdefault('backoff_base', 0)
+    kwargs.setdefault('backoff_max', 0)
+    return Marathon(hosts, **kwargs)
+
+
+def refuse(method, url):
+    raise requests.ConnectionError("refused")
+
+
+def test_breaker_opens_after_threshold_failures(monkeypatch):
+    fake = FakeRequests(monkeypatch, refuse)
+    m = client(max_retries=0, breaker_threshold=3, breaker_reset=30)
+    for i in range(3):
+        with pytest.raises(requests.ConnectionError):
+            m._make_request('GET', 'v2/apps')
+    with pytest.raises(MarathonUnavailable):
+        m._make_request('GET', 'v2/apps')
+    assert len(fake.calls) == 3
+    assert m.stats['breaker_trips'] == 1
+    assert m.stats['breaker_rejections'] == 1
+
+
+def test_retries_stop_once_the_breaker_opens(monkeypatch):
+    fake = FakeRequests(monkeypatch, refuse)
+    m = client(max_retries=10, breaker_threshold=2)
+    with pytest.raises(requests.ConnectionError):
+        m._make_request('GET', 'v2/apps')
+    assert len(fake.calls) == 2
+
+
+def test_half_open_breaker_lets_exactly_one_trial_through(monkeypatch):
+    release = threading.Event()
+    entered = threading.Event()
+
+    def slow_ok(method, url):
+        entered.set()
+        release.wait(5)
+        return FakeResponse(200)
+
+    fake = FakeRequests(monkeypatch, refuse)
+    m = client(max_retries=0, breaker_threshold=1, breaker_reset=30)
+    with pytest.raises(requests.ConnectionError):
+        m._make_request('GET', 'v2/apps')
+    # The reset period is over
+    m.breaker_open_until = time.time() - 1
+    fake.handler = slow_ok
+
+    results = []
+    trial = threading.Thread(target=lambda: results.append(m._make_request('GET', 'v2/apps').status_code))
+    trial.start()
+    assert entered.wait(5)
+    # While the trial is in flight everything else fails fast
+    for i in range(3):
+        with pytest.raises(MarathonUnavailable):
+            m._make_request('GET', 'v2/apps')
+    release.set()
+    trial.join(5)
+
+    assert results == [200]
+    assert len(fake.calls) == 2
+    # The successful trial closed the breaker
+    assert m._make_request('GET', 'v2/apps').status_code == 200
+    assert not m.breaker_trial
+
+
+def test_failed_trial_reopens_the_breaker(monkeypatch):
+    fake = FakeRequests(monkeypatch, refuse)
+    m = client(max_retries=3, breaker_threshold=2, breaker_reset=30)
+    with pytest.raises(requests.ConnectionError):
+        m._make_request('GET', 'v2/apps')
+    m.breaker_open_until = time.time() - 1
+    calls = len(fake.calls)
+
+    with pytest.raises(requests.ConnectionError):
+        m._make_request('GET', 'v2/apps')
+    # The trial is a single attempt, not retried
+    assert len(fake.calls) == calls + 1
+    assert m.stats['breaker_trips'] == 2
+    with pytest.raises(MarathonUnavailable):
+        m._make_request('GET', 'v2/apps')
+
+
+def test_idempotent_requests_are_retried_on_503(monkeypatch):
+    answers = [FakeResponse(503), FakeResponse(503), FakeResponse(200)]
+    fake = FakeRequests(monkeypatch, lambda method, url: answers.pop(0))
+    m = client(max_retries=3)
+    assert m._make_request('GET', 'v2/apps').status_code == 200
+    assert len(fake.calls) == 3
+    assert m.stats['retries'] == 2
+    assert m.consecutive_failures == 0
+
+
+def test_retries_respect_the_budget(monkeypatch):
+    fake = FakeRequests(monkeypatch, lambda method, url: FakeResponse(503))
+    m = client(max_retries=5, backoff_base=0.2, backoff_max=0.2, retry_budget=0.3, breaker_threshold=100)
+    assert m._make_request('GET', 'v2/apps').status_code == 503
+    assert len(fake.calls) == 2
+
+
+def test_posts_are_not_retried(monkeypatch):
+    def timeout(method, url):
+        raise requests.Timeout("read timed out")
+
+    fake = FakeRequests(monkeypatch, timeout)
+    m = client('http://a:8080,http://b:8080', max_retries=3)
+    with pytest.raises(requests.Timeout):
+        m._make_request('POST', 'v2/apps', json_data={})
+    # Marathon may already be processing it, not even sent to the other master
+    assert len(fake.calls) == 1
+
+
+def test_slow_read_is_hedged_to_another_master(monkeypatch):
+    first = []
+
+    def answer(method, url):
+        host = url.split('/')[2]
+        if not first:
+            first.append(host)
+            time.sleep(0.5)
+        return FakeResponse(200, host=host)
+
+    FakeRequests(monkeypatch, answer)
+    m = client('http://a:8080,http://b:8080', hedge_delay=0.05)
+    response = m._make_request('GET', 'v2/apps/x', hedge=True)
+    assert response.host != first[0]
+    assert m.stats['hedged'] == 1
+    assert m.stats['hedge_wins'] == 1
+
+
+def test_fast_read_is_not_hedged(monkeypatch):
+    fake = FakeRequests(monkeypatch, lambda method, url: FakeResponse(200))
+    m = client('http://a:8080,http://b:8080', hedge_delay=1)
+    m._make_request('GET', 'v2/apps/x', hedge=True)
+    assert len(fake.calls) == 1
+    assert m.stats['hedged'] == 0
+
+
+def leader_b(method, url):
+    if url.endswith('/ping'):
+        return FakeResponse(200)
+    if url.endswith('/v2/leader'):
+        return FakeResponse(200, {'leader': 'b:8080'})
+    return FakeResponse(201)
+
+
+def test_writes_go_to_the_leader(monkeypatch):
+    fake = FakeRequests(monkeypatch, leader_b)
+    m = client('http://a:8080,http://b:8080,http://c:8080')
+    m.check_health()
+    assert m.leader == 'http://b:8080'
+    del fake.calls[:]
+    m._make_request('POST', 'v2/apps', json_data={})
+    assert fake.calls == [('post', 'http://b:8080/v2/apps')]
+
+
+def test_writes_fail_over_when_the_leader_is_unreachable(monkeypatch):
+    fake = FakeRequests(monkeypatch, leader_b)
+    m = client('http://a:8080,http://b:8080,http://c:8080')
+    m.check_health()
+
+    def leader_down(method, url):
+        if url.startswith('http://b:8080'):
+            raise requests.ConnectionError("refused")
+        return FakeResponse(201)
+
+    fake.handler = leader_down
+    del fake.calls[:]
+    assert m._make_request('POST', 'v2/apps', json_data={}).status_code == 201
+    assert [url.split('/')[2] for method, url in fake.calls] == ['b:8080', 'a:8080']
+    assert m.leader is None
+    assert not m._is_healthy('http://b:8080')
+    # Skipped while it cools down
+    del fake.calls[:]
+    m._make_request('POST', 'v2/apps', json_data={})
+    assert fake.calls == [('post', 'http://a:8080/v2/apps')]
+
+
+def app_listing(count=20):
+    apps = [{
+        'id': '/notebooks/user%i-notebook' % i,
+        'version': '2016-10-19T00:00:%02iZ' % (i % 60),
+        # Multi-byte characters get split across chunks too
+        'labels': {'owner': 'ünïcødé-%i' % i, 'padding': 'x' * (i * 37)},
+        'tasks': [{'state': 'TASK_RUNNING', 'host': 'agent%i' % i, 'ports': [31000 + i]}],
+    } for i in range(count)]
+    body = json.dumps({'apps': apps}, indent=1).encode('utf-8')
+    return apps, body
+
+
+def split(body, size):
+    return [body[i:i + size] for i in range(0, len(body), size)]
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 64, 1000, 1 << 20])
+def test_iter_apps_yields_the_same_apps_for_any_chunk_size(size):
+    apps, body = app_listing()
+    assert list(marathon.iter_apps(split(body, size))) == apps
+
+
+def test_iter_apps_handles_every_split_boundary():
+    apps, body = app_listing(3)
+    for cut in range(1, len(body)):
+        assert list(marathon.iter_apps([body[:cut], body[cut:]])) == apps
+
+
+def test_iter_apps_of_an_empty_listing():
+    assert list(marathon.iter_apps([b'{"apps": [', b']}'])) == []
+    assert list(marathon.iter_apps([b'{}'])) == []
+
+
+def test_iter_apps_rejects_a_truncated_listing():
+    apps, body = app_listing(2)
+    with pytest.raises(ValueError):
+        list(marathon.iter_apps(split(body[:len(body) // 2], 16)))
+
+
+def test_iter_apps_reads_large_apps_in_growing_steps(monkeypatch):
+    attempts = []
+    decoder = json.JSONDecoder
+
+    class CountingDecoder(decoder):
+        def raw_decode(self, s, idx=0):
+            attempts.append(idx)
+            return decoder.raw_decode(self, s, idx)
+
+    monkeypatch.setattr(marathon.json, 'JSONDecoder', CountingDecoder)
+    app = {'id': '/notebooks/big-notebook', 'env': dict(('KEY%i' % i, 'v' * 100) for i in range(2000))}
+    body = json.dumps({'apps': [app]}).encode('utf-8')
+    assert len(body) > 200000
+    assert list(marathon.iter_apps(split(body, 1024))) == [app]
+    # Each failed attempt at least doubles the buffer: logarithmic in the app size, not one per chunk
+    assert len(attempts) < 15
@@ -0,0 +1,68 @@
+import pytest
+
+from l41_nbhub.QuotaTracker import QuotaExceeded, QuotaTracker
+
+
+def test_user_limits_are_enforced():
+    quotas = QuotaTracker(user_limits={'gpus': 4})
+    quotas.check('alice', None, 4, 1024)
+    with pytest.raises(QuotaExceeded):
+        quotas.check('alice', None, 5, 1024)
+
+
+def test_group_limits_count_every_member():
+    quotas = QuotaTracker(group_limits={'gpus': 4, 'servers': 2})
+    quotas.charge('alice', 100, 3, 1024)
+    with pytest.raises(QuotaExceeded):
+        quotas.charge('bob', 100, 2, 1024)
+    # Other groups and users without a group are not affected
+    quotas.charge('carol', 200, 4, 1024)
+    quotas.charge('dave', None, 4, 1024)
+    quotas.charge('bob', 100, 1, 1024)
+    with pytest.raises(QuotaExceeded):
+        quotas.charge('erin', 100, 0, 1024)
+    assert quotas.used('group', 100, 'gpus') == 4
+    assert quotas.used('group', 100, 'servers') == 2
+
+
+def test_a_server_can_be_restarted_at_the_same_size():
+    quotas = QuotaTracker(user_limits={'gpus': 2, 'mem': 2048}, group_limits={'gpus': 2})
+    quotas.charge('alice', 100, 2, 2048)
+    quotas.charge('alice', 100, 2, 2048)
+    assert quotas.used('user', 'alice', 'gpus') == 2
+    assert quotas.used('group', 100, 'servers') == 1
+    with pytest.raises(QuotaExceeded):
+        quotas.charge('alice', 100, 3, 2048)
+    # The failed charge left the holding as it was
+    assert quotas.holdings['alice'] == (100, dict(gpus=2, mem=2048, servers=1))
+
+
+def test_release_gives_back_what_was_charged():
+    quotas = QuotaTracker(group_limits={'gpus': 4})
+    quotas.charge('alice', 100, 2, 1024)
+    quotas.charge('bob', 100, 2, 1024)
+    quotas.release('alice')
+    assert ('user', 'alice') not in quotas.usage
+    assert quotas.used('group', 100, 'gpus') == 2
+    quotas.release('bob')
+    assert quotas.usage == {}
+    assert quotas.holdings == {}
+    # Releasing twice is harmless
+    quotas.release('bob')
+
+
+def test_unchecked_charges_may_go_over_the_limit():
+    quotas = QuotaTracker(user_limits={'gpus': 1})
+    quotas.charge('alice', None, 2, 1024, check=False)
+    assert quotas.used('user', 'alice', 'gpus') == 2
+
+
+def test_zero_means_no_limit():
+    quotas = QuotaTracker(user_limits={'gpus': 0})
+    quotas.check('alice', None, 100, 1024)
+
+
+@pytest.mark.parametrize('limits', [dict(user_limits={'cpus': 4}), dict(group_limits={'disk': 10})])
+def test_unknown_resources_are_rejected(limits):
+    with pytest.raises(ValueError):
+        QuotaTracker(**limits)
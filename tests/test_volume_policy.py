@@ -0,0 +1,95 @@
+import pytest
+
+from l41_nbhub.VolumePolicy import VolumePolicy, merge_volumes
+
+
+def test_mounts_under_an_allowed_prefix_are_accepted():
+    policy = VolumePolicy(['/data/shared', ('/data/readonly', 'RO')])
+    assert policy.validate(['/data/shared/projects']) == [('/data/shared/projects', '/data/shared/projects', 'RW')]
+    assert policy.validate([('/data/shared/a/', '/mnt/a', 'ro')]) == [('/data/shared/a', '/mnt/a', 'RO')]
+
+
+@pytest.mark.parametrize('volume', [
+    '/etc',
+    '/data',
+    '/data/sharedsecrets',
+    '/data/shared/../../etc/passwd',
+    ('/data/shared', 'relative/path'),
+])
+def test_mounts_outside_the_allowed_prefixes_are_rejected(volume):
+    policy = VolumePolicy(['/data/shared'])
+    with pytest.raises(ValueError):
+        policy.validate([volume])
+
+
+def test_read_only_prefixes_force_read_only_mounts():
+    policy = VolumePolicy([('/data/readonly', 'RO')])
+    assert policy.validate([('/data/readonly/x', '/x', 'RW')]) == [('/data/readonly/x', '/x', 'RO')]
+
+
+def test_the_most_specific_prefix_decides_the_mode():
+    policy = VolumePolicy(['/data', ('/data/archive', 'RO'), '/data/archive/scratch'])
+    assert policy.validate(['/data/archive/2016'])[0][2] == 'RO'
+    assert policy.validate(['/data/archive/scratch/run1'])[0][2] == 'RW'
+    assert policy.validate(['/data/other'])[0][2] == 'RW'
+
+
+@pytest.mark.parametrize('mode', ['rx', 1, None])
+def test_invalid_modes_are_rejected(mode):
+    policy = VolumePolicy(['/data'])
+    with pytest.raises(ValueError):
+        policy.validate([('/data/a', '/a', mode)])
+
+
+def test_invalid_configured_modes_are_rejected():
+    with pytest.raises(ValueError):
+        VolumePolicy([('/data', 'WO')])
+
+
+def test_duplicate_mounts_are_merged_and_conflicts_rejected():
+    policy = VolumePolicy(['/data'])
+    assert policy.validate(['/data/a', ('/data/a', '/data/a', 'RW')]) == [('/data/a', '/data/a', 'RW')]
+    with pytest.raises(ValueError):
+        policy.validate([('/data/a', '/mnt'), ('/data/b', '/mnt')])
+
+
+def test_templated_prefixes_are_expanded_per_user():
+    policy = VolumePolicy(['/home/{USERNAME}'])
+    alice = lambda path: path.format(USERNAME='alice')
+    assert policy.validate(['/home/alice/notebooks'], alice)
+    with pytest.raises(ValueError):
+        policy.validate(['/home/bob/notebooks'], alice)
+
+
+def test_expand_is_not_called_without_templated_prefixes():
+    def expand(path):
+        raise AssertionError("expanded %s" % path)
+
+    assert VolumePolicy(['/data']).validate(['/data/a'], expand)
+
+
+def test_the_trie_cache_evicts_the_least_recently_used_user():
+    policy = VolumePolicy(['/home/{USERNAME}'], cache_size=2)
+    compiled = []
+    compile_trie = policy._compile
+    policy._compile = lambda prefixes: compiled.append(prefixes) or compile_trie(prefixes)
+
+    def expand_for(username):
+        return lambda path: path.format(USERNAME=username)
+
+    for username in ('alice', 'bob', 'alice', 'carol'):
+        policy.trie_for(expand_for(username))
+    assert len(policy.compiled) == 2
+    # alice was used after bob, bob went out when carol came in
+    assert [prefixes[0][0] for prefixes in policy.compiled] == ['/home/alice', '/home/carol']
+    assert len(compiled) == 3
+
+    policy.trie_for(expand_for('bob'))
+    assert len(compiled) == 4
+    assert len(policy.compiled) == 2
+
+
+def test_merge_volumes_skips_mounted_container_paths():
+    configured = ['/data', ('/scratch', '/tmp/scratch')]
+    merged = merge_volumes(configured, [('/data/x', '/data/'), ('/home/alice', '/home/alice', 'RO')])
+    assert merged == configured + [('/home/alice', '/home/alice', 'RO')]